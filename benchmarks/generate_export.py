@@ -0,0 +1,125 @@
+"""Write a synthetic Spotify extended streaming history export of a chosen number of plays."""
+import argparse
+import json
+import random
+import string
+from datetime import datetime, timezone
+from itertools import accumulate
+from pathlib import Path
+
+PLAYS_PER_FILE = 20000 # Roughly what Spotify puts in each Streaming_History_Audio file
+SYLLABLES = ("ka", "lo", "mi", "ra", "ven", "to", "sha", "el", "dri", "nu", "fa", "ye", "mon", "bel", "qui", "sto", "ar", "lin", "ko", "zu")
+REASONS_END = ("trackdone", "fwdbtn", "endplay", "logout", "unexpected-exit-while-paused")
+BASE62 = string.digits + string.ascii_letters
+
+def name(rng, words):
+    return " ".join(
+        "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3))).capitalize()
+        for _ in range(rng.randint(*words))
+    )
+
+def uri(rng, kind):
+    return f"spotify:{kind}:{''.join(rng.choice(BASE62) for _ in range(22))}"
+
+def zipf_weights(n, s=1.1):
+    # Cumulative weights for random.choices, rank r drawn with probability proportional to 1 / r^s
+    return list(accumulate(1 / (rank ** s) for rank in range(1, n + 1)))
+
+def catalogue(rng, plays):
+    # Artists grow with the history size, each with a few albums of a handful of tracks
+    artists = []
+    for _ in range(max(20, plays // 250)):
+        artist = name(rng, (1, 2))
+        tracks = []
+        for _ in range(rng.randint(1, 4)):
+            album = name(rng, (1, 4))
+            tracks += [(name(rng, (1, 4)), artist, album, uri(rng, "track")) for _ in range(rng.randint(3, 14))]
+        rng.shuffle(tracks)
+        artists.append(tracks)
+    return artists
+
+def generate(folder, plays, years=5, null_rate=0.03, skip_rate=0.12, seed=0):
+    rng = random.Random(seed)
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    artists = catalogue(rng, plays)
+    artist_weights = zipf_weights(len(artists))
+    track_weights = [zipf_weights(len(tracks)) for tracks in artists]
+    episodes = [(name(rng, (1, 3)), name(rng, (1, 2)), uri(rng, "episode")) for _ in range(50)]
+
+    # Plays are spread evenly over the years before the end of 2025, in time order
+    end = datetime(2026, 1, 1, tzinfo=timezone.utc).timestamp()
+    ts = end - years * 365 * 86400
+    gap = years * 365 * 86400 / plays
+    files = []
+    for first in range(0, plays, PLAYS_PER_FILE):
+        records = []
+        for _ in range(min(PLAYS_PER_FILE, plays - first)):
+            ts += rng.uniform(0, 2 * gap)
+            record = {
+                "ts": datetime.fromtimestamp(int(ts), timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "platform": "ios",
+                "ms_played": 0,
+                "conn_country": "AU",
+                "master_metadata_track_name": None,
+                "master_metadata_album_artist_name": None,
+                "master_metadata_album_album_name": None,
+                "spotify_track_uri": None,
+                "episode_name": None,
+                "episode_show_name": None,
+                "spotify_episode_uri": None,
+                "reason_start": "trackdone",
+                "reason_end": "trackdone",
+                "shuffle": rng.random() < 0.3,
+                "skipped": False,
+                "offline": False,
+                "offline_timestamp": None,
+                "incognito_mode": False,
+            }
+            if rng.random() < null_rate:
+                # Video and podcast plays have no track metadata
+                record["episode_name"], record["episode_show_name"], record["spotify_episode_uri"] = rng.choice(episodes)
+                record["ms_played"] = rng.randint(0, 3600000)
+            else:
+                artist = rng.choices(range(len(artists)), cum_weights=artist_weights)[0]
+                track = rng.choices(artists[artist], cum_weights=track_weights[artist])[0]
+                (
+                    record["master_metadata_track_name"],
+                    record["master_metadata_album_artist_name"],
+                    record["master_metadata_album_album_name"],
+                    record["spotify_track_uri"]
+                ) = track
+                if rng.random() < skip_rate:
+                    record["skipped"] = True
+                    record["reason_end"] = "fwdbtn"
+                    record["ms_played"] = rng.randint(0, 30000)
+                else:
+                    record["ms_played"] = rng.randint(30001, 360000)
+                    record["reason_end"] = rng.choice(REASONS_END)
+            records.append(record)
+
+        year = datetime.fromtimestamp(int(ts), timezone.utc).year
+        file = folder / f"Streaming_History_Audio_{year}_{len(files)}.json"
+        with open(file, "w", encoding="utf-8") as f:
+            # One play per line, which parses the same as Spotify's indented files and writes far faster
+            f.write("[\n")
+            f.write(",\n".join(json.dumps(record, ensure_ascii=False) for record in records))
+            f.write("\n]\n")
+        files.append(file)
+    return files
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("folder", help="Folder to write the export files into")
+    parser.add_argument("--plays", type=int, default=100000)
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--null-rate", type=float, default=0.03, help="Fraction of video and podcast plays without track metadata")
+    parser.add_argument("--skip-rate", type=float, default=0.12)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    files = generate(args.folder, args.plays, args.years, args.null_rate, args.skip_rate, args.seed)
+    print(f"Wrote {args.plays} plays to {len(files)} file(s) in {args.folder}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Compare memory held by the dict-of-lists play layout and the columnar PlayStore."""
+import argparse
+import json
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import myspotifystats as mss
+
+def load_plays(folder, repeat):
+    plays = []
+    for file in sorted(Path(folder).glob("*.json")):
+        with open(file, "r") as f:
+            plays.extend(json.load(f))
+    # Repeat the sample with fresh dicts to approximate a multi-year export, varying each copy so ingest does not drop it as a duplicate
+    return [dict(play, ms_played=play["ms_played"] + i) for i in range(repeat) for play in plays]
+
+def dict_layout(plays):
+    # The layout ProcessedData used before the columnar store
+    song_plays, artist_plays, album_plays = {}, {}, {}
+    for play in plays:
+        artist = play["master_metadata_album_artist_name"]
+        track = play["master_metadata_track_name"]
+        if artist is None or track is None:
+            continue
+        artist_plays.setdefault(artist, []).append(play)
+        album_plays.setdefault(play["master_metadata_album_album_name"], []).append(play)
+        song_plays.setdefault((track, artist), []).append(play)
+    return song_plays, artist_plays, album_plays
+
+def measure(build):
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data", default=".data")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    (plays, layout), dict_size = measure(lambda: (lambda p: (p, dict_layout(p)))(load_plays(args.data, args.repeat)))
+    del plays, layout
+    records = [{field: play.get(field) for field in mss.FIELDS} for play in load_plays(args.data, args.repeat)]
+    pd, store_size = measure(lambda: mss.process_data(None, iter(records)))
+
+    print(f"Plays: {len(pd.store)}")
+    print(f"Dict-of-lists layout: {dict_size / 2**20:.1f} MiB")
+    print(f"Columnar store: {store_size / 2**20:.1f} MiB")
+
+if __name__ == "__main__":
+    main()
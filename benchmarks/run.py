@@ -0,0 +1,155 @@
+"""Time ingest, aggregation, filtered ranking and search over synthetic exports of several sizes.
+
+Each size runs in its own process so its peak memory is measured alone. Results are written
+as JSON, and a previous results file can be passed to --compare to print the change per stage.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import myspotifystats as mss
+from generate_export import generate
+
+SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+STAGES = ("ingest", "aggregate", "ranking", "search_index", "search")
+REPEAT = 5 # Runs of the ranking and search stages, the fastest being kept
+SEARCHES = 20 # Queries per search run
+
+def best(run, repeat=REPEAT):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench(folder, workers):
+    files = sorted(Path(folder).glob("*.json"))
+    timings = {}
+
+    # Time grouping apart from the rest of process_data, which is parsing and the store
+    group_plays = mss.group_plays
+    def timed_group_plays(store, *args):
+        start = time.perf_counter()
+        pd = group_plays(store, *args)
+        timings["aggregate"] = time.perf_counter() - start
+        return pd
+    mss.group_plays = timed_group_plays
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        pd = mss.process_data(None, mss.parse_data(SimpleNamespace(workers=workers), files))
+    timings["ingest"] = time.perf_counter() - start - timings["aggregate"]
+    mss.group_plays = group_plays
+
+    # Rank the middle year of the history, as the filter command would
+    store = pd.store
+    middle = (store.ts[0] + store.ts[-1]) // 2
+    lo, hi = store.window(middle - 182 * 86400, middle + 182 * 86400)
+    timings["ranking"] = best(lambda: [
+        mss.rank_objects(cmd, object_plays, store, lo, hi, mss.RESULTS)
+        for cmd, object_plays in ((mss.Cmd.TRACKS, pd.song_plays), (mss.Cmd.ARTISTS, pd.artist_plays), (mss.Cmd.ALBUMS, pd.album_plays))
+    ])
+
+    start = time.perf_counter()
+    search = mss.search_index(pd)
+    timings["search_index"] = time.perf_counter() - start
+
+    # Misspell real names by dropping a character, as typed queries often are
+    rng = random.Random(0)
+    def typo(name):
+        i = rng.randrange(len(name))
+        return name[:i] + name[i + 1:]
+    artists = [typo(artist) for artist in rng.sample(list(pd.artist_plays), min(SEARCHES, len(pd.artist_plays)))]
+    albums = [typo(album) for album in rng.sample(list(pd.album_plays), min(SEARCHES, len(pd.album_plays)))]
+    songs = rng.sample(list(pd.song_plays), min(SEARCHES, len(pd.song_plays)))
+    def searches():
+        for artist in artists:
+            search.artists.extract(artist, mss.ARTIST_SCORERS, limit=1, score_cutoff=50)
+        for album in albums:
+            search.albums.extract(album, mss.ALBUM_SCORERS, limit=5)
+        for track, artist, *_ in songs:
+            search.songs.extract(typo(track), mss.TRACK_SCORERS, limit=5, score_cutoff=80, positions=search.artist_positions[artist])
+    timings["search"] = best(searches)
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {
+        "plays": len(store),
+        "files": len(files),
+        **{f"{stage}_s": round(timings[stage], 4) for stage in STAGES},
+        "peak_rss_mib": round(peak / 2**20, 1)
+    }
+
+def run_size(size, workers, exports):
+    folder = Path(exports) / str(size)
+    if not folder.exists():
+        print(f"Generating {size} plays in {folder}...", flush=True)
+        generate(folder, size)
+    # A fresh process per size keeps each peak memory reading separate
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return {"size": size, **pool.apply(bench, (folder, workers))}
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, path):
+    with open(path) as f:
+        previous = {result["size"]: result for result in json.load(f)["results"]}
+    print(f"Compared with {path}:")
+    for result in results:
+        old = previous.get(result["size"])
+        if old is None:
+            continue
+        changes = ", ".join(
+            f"{key} {result[key] / old[key]:.2f}x" for key in (*(f"{stage}_s" for stage in STAGES), "peak_rss_mib") if old.get(key)
+        )
+        print(f"  {result['size']}: {changes}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="Plays per generated export")
+    parser.add_argument("--workers", type=int, default=1, help="Processes used to parse export files")
+    parser.add_argument("--exports", help="Folder to keep generated exports in between runs, a temporary folder by default")
+    parser.add_argument("--output", default="bench_output.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp:
+        results = []
+        for size in args.sizes:
+            result = run_size(size, args.workers, args.exports or temp)
+            print(", ".join(f"{key} {value}" for key, value in result.items()), flush=True)
+            results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "commit": commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "workers": args.workers,
+            "results": results
+        }, f, indent=2)
+        f.write("\n")
+    print(f"Wrote {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Check the Spotify client code offline against a local stub of the Web API.
+
+The stub answers the endpoints the app calls from memory, and the client is given a fixed
+token in place of the OAuth flow, so no account or network access is needed. Playlist adds
+can be made to fail with rate limits or server errors to check how uploads recover.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import spotipy
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import myspotifystats as mss
+
+class StubAuth:
+    """Stands in for SpotifyOAuth, handing out a fixed token without calling accounts.spotify.com."""
+
+    def get_access_token(self, as_dict=True, check_cache=True):
+        return {"access_token": "stub-token"} if as_dict else "stub-token"
+
+class Stub:
+    """In-memory Web API state, with every request logged as (method, path, query)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.playlists = {} # Playlist ID to its track URIs in order
+        self.faults = {} # Number of a playlist add request to the (status, applied) error it gets instead
+        self.adds = 0
+
+    def add_items(self, playlist_id, uris, position):
+        # Returns the error status for this request, if one was planned, after applying the add when the fault says so
+        with self.lock:
+            self.adds += 1
+            status, applied = self.faults.get(self.adds, (None, True))
+            if applied:
+                items = self.playlists[playlist_id]
+                position = len(items) if position is None else position
+                items[position:position] = uris
+            return status
+
+    def tracks(self, ids):
+        return {"tracks": [
+            {"uri": f"spotify:track:{id}", "id": id, "name": f"Track {id}", "popularity": len(id) % 101}
+            for id in ids
+        ]}
+
+def handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            path, query = url.path.rstrip("/"), parse_qs(url.query)
+            with stub.lock:
+                stub.requests.append(("GET", path, query))
+            if self.headers.get("Authorization") != "Bearer stub-token":
+                return self.reply(401, {"error": {"status": 401, "message": "No token provided"}})
+            if path == "/v1/tracks":
+                return self.reply(200, stub.tracks(query["ids"][0].split(",")))
+            if path == "/v1/me":
+                return self.reply(200, {"id": "stub-user"})
+            self.reply(404, {"error": {"status": 404, "message": "Not found"}})
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            path, query = url.path.rstrip("/"), parse_qs(url.query)
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "null")
+            with stub.lock:
+                stub.requests.append(("POST", path, query))
+            if self.headers.get("Authorization") != "Bearer stub-token":
+                return self.reply(401, {"error": {"status": 401, "message": "No token provided"}})
+            parts = path.split("/")
+            if parts[2:3] == ["users"] and parts[4:] == ["playlists"]:
+                with stub.lock:
+                    playlist_id = f"stubplaylist{len(stub.playlists)}"
+                    stub.playlists[playlist_id] = []
+                return self.reply(201, {"id": playlist_id, "name": body["name"]})
+            if parts[2:3] == ["playlists"] and parts[4:] in (["items"], ["tracks"]):
+                position = int(query["position"][0]) if "position" in query else None
+                status = stub.add_items(parts[3], body, position)
+                if status == 429:
+                    return self.reply(429, {"error": {"status": 429, "message": "API rate limit exceeded"}}, {"Retry-After": "0"})
+                if status:
+                    return self.reply(status, {"error": {"status": status, "message": "Bad gateway"}})
+                return self.reply(201, {"snapshot_id": f"snapshot{stub.adds}"})
+            self.reply(404, {"error": {"status": 404, "message": "Not found"}})
+
+        def reply(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def check(name, passed, detail=""):
+    print(f"{'ok  ' if passed else 'FAIL'} {name}{f': {detail}' if detail else ''}")
+    return passed
+
+def check_metadata(stub, client, folder):
+    uris = [f"spotify:track:{i:022d}" for i in range(120)]
+    cache = mss.MetadataCache(Path(folder) / mss.METADATA_FILE, client=client)
+    stub.requests.clear()
+    tracks = cache.get(uris)
+    sizes = [len(query["ids"][0].split(",")) for _, path, query in stub.requests if path == "/v1/tracks"]
+    results = [check("metadata batches", sizes == [50, 50, 20] and len(tracks) == 120, f"requests of {sizes}")]
+
+    stub.requests.clear()
+    cache.get(uris)
+    results.append(check("metadata served from SQLite", not stub.requests, f"{len(stub.requests)} request(s)"))
+
+    stub.requests.clear()
+    cache.ttl = -1
+    cache.get(uris[:10])
+    results.append(check("expired metadata refetched", len(stub.requests) == 1, f"{len(stub.requests)} request(s)"))
+    return all(results)
+
+def make_playlist(stub, client, uris, faults):
+    stub.faults, stub.adds = faults, 0
+    playlist_id = mss.call_api(client.user_playlist_create, user=mss.current_user_id(), name="stub", public=False, idempotent=False)["id"]
+    try:
+        mss.upload_playlist(client, playlist_id, uris)
+        error = None
+    except spotipy.SpotifyException as e:
+        error = e.http_status
+    return stub.playlists[playlist_id], error
+
+def check_playlist(stub, client):
+    uris = [f"spotify:track:{i:022d}" for i in range(1050)]
+
+    # Rate limited adds are not applied, so retrying them keeps every chunk in order
+    items, error = make_playlist(stub, client, uris, {2: (429, False), 5: (429, False), 6: (429, False)})
+    results = [check("playlist order under rate limits", items == uris and error is None, f"{len(items)} of {len(uris)} tracks in order")]
+
+    # A server error after the add was applied must not be retried, or the chunk would be inserted twice
+    items, error = make_playlist(stub, client, uris, {3: (502, True)})
+    duplicates = len(items) - len(set(items))
+    results.append(check("no duplicates after a server error", error == 502 and duplicates == 0, f"error {error}, {duplicates} duplicate(s)"))
+    return all(results)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    stub = Stub()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler(stub))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["SPOTIFY_API_PREFIX"] = f"http://127.0.0.1:{server.server_port}/v1/"
+    client = mss.spotify_client(StubAuth())
+    mss.API_BACKOFF = 0
+    # Planned errors would otherwise be logged by spotipy as they happen
+    logging.getLogger("spotipy").setLevel(logging.CRITICAL)
+
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            passed = check_metadata(stub, client, folder)
+        passed = check_playlist(stub, client) and passed
+    finally:
+        server.shutdown()
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compare strptime-per-use timestamps against the epoch column parsed once at ingest."""
+import argparse
+import sys
+import timeit
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import myspotifystats as mss
+
+FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+def strptime_tracks(song_plays, start, end):
+    # What a filtered `tracks` command did per play before the epoch column
+    filtered = {
+        song: kept
+        for song, plays in song_plays.items()
+        if (kept := [play for play in plays if start <= datetime.strptime(play["ts"], FORMAT) <= end])
+    }
+    plays = [play for kept in filtered.values() for play in kept]
+    return min(plays, key=lambda play: datetime.strptime(play["ts"], FORMAT))
+
+def epoch_tracks(pd, start, end):
+    start, end, ts = mss.epoch(start), mss.epoch(end), pd.store.ts
+    filtered = {
+        song: kept
+        for song, plays in pd.song_plays.items()
+        if (kept := [play for play in plays.rows if start <= ts[play] <= end])
+    }
+    plays = [play for kept in filtered.values() for play in kept]
+    return min(plays, key=ts.__getitem__)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--data", default=".data")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    records = [
+        record
+        for file in sorted(Path(args.data).glob("*.json"))
+        for record in mss.iter_records(file)
+    ]
+    # Vary each copy so ingest does not drop it as a duplicate, keeping both paths on the same plays
+    records = [dict(record, ms_played=record["ms_played"] + i) for i in range(args.repeat) for record in records]
+    stamps = [record["ts"] for record in records]
+    pd = mss.process_data(None, iter(records))
+    # The same counted plays as pd.song_plays, as export dicts whose timestamps are strings again
+    song_plays = {
+        song: [{"ts": pd.store.date(row).strftime(FORMAT)} for row in plays.rows]
+        for song, plays in pd.song_plays.items()
+    }
+    start, end = datetime(2020, 1, 1), datetime.max
+
+    parse_old = min(timeit.repeat(lambda: [datetime.strptime(ts, FORMAT) for ts in stamps], number=1, repeat=3))
+    parse_new = min(timeit.repeat(lambda: [mss.parse_ts(ts) for ts in stamps], number=1, repeat=3))
+    cmd_old = min(timeit.repeat(lambda: strptime_tracks(song_plays, start, end), number=1, repeat=3))
+    cmd_new = min(timeit.repeat(lambda: epoch_tracks(pd, start, end), number=1, repeat=3))
+
+    print(f"Timestamps: {len(stamps)}")
+    print(f"Parse: strptime {parse_old * 1000:.1f} ms, parse_ts {parse_new * 1000:.1f} ms ({parse_old / parse_new:.1f}x)")
+    print(f"Filtered tracks: strptime {cmd_old * 1000:.1f} ms, epoch column {cmd_new * 1000:.1f} ms ({cmd_old / cmd_new:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""Compare a full sort against top_k() selection over ranking rows of varying size."""
+import argparse
+import random
+import sys
+import timeit
+from operator import itemgetter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import myspotifystats as mss
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entities", type=int, nargs="+", default=[1000, 10000, 50000, 200000])
+    parser.add_argument("--k", type=int, nargs="+", default=[10, 50, 500, 5000])
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f"{'entities':>9} {'k':>6} {'sorted ms':>10} {'top_k ms':>9} {'speedup':>8}")
+    for n in args.entities:
+        # (key, count, ms_played, first play) rows with Zipf-like counts and plenty of ties
+        rows = [(i, int(n / (i + 1)), random.randrange(10**7), i) for i in range(n)]
+        random.shuffle(rows)
+        key = itemgetter(1)
+        for k in args.k:
+            if k > n:
+                continue
+            assert mss.top_k(rows, k, key) == sorted(rows, key=key, reverse=True)[:k]
+            full = min(timeit.repeat(lambda: sorted(rows, key=key, reverse=True)[:k], number=1, repeat=5))
+            selected = min(timeit.repeat(lambda: mss.top_k(rows, k, key), number=1, repeat=5))
+            print(f"{n:>9} {k:>6} {full * 1000:>10.2f} {selected * 1000:>9.2f} {full / selected:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -2,28 +2,426 @@ import os
 import json
 import argparse
 import re
-import difflib
 import spotipy
 import readline
 import atexit
 import shutil
-from itertools import chain
-from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
+import time
+import calendar
+import mmap
+import struct
+import sys
+import sqlite3
+import threading
+import requests
+import heapq
+import csv
+import shlex
+import multiprocessing
+import asyncio
+import io
+import cProfile
+import pstats
+import tracemalloc
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, islice, repeat
+from collections import deque
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth, SpotifyOauthError
+from requests.adapters import HTTPAdapter
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from dateutil import parser
+from contextlib import nullcontext, redirect_stdout
 from dataclasses import dataclass
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from enum import Enum, auto
 from dotenv import load_dotenv
 from rapidfuzz import process, fuzz
 
+class PlayStore:
+    """Column layout of ingested plays, with names interned into string tables."""
+    COLUMNS = ("ts", "ms_played", "skipped", "track", "artist", "album", "uri", "source")
+    TABLES = ("tracks", "artists", "albums", "uris", "sources")
+
+    def __init__(self):
+        self.ts = array("q") # Epoch seconds
+        self.ms_played = array("l")
+        self.skipped = array("b")
+        self.track = array("l") # Indexes into the string tables below
+        self.artist = array("l")
+        self.album = array("l")
+        self.uri = array("l")
+        self.source = array("l")
+        self.tracks = []
+        self.artists = []
+        self.albums = []
+        self.uris = []
+        self.sources = [] # Export file names
+        self.manifest = {} # Export file name to [size, mtime_ns] when it was ingested
+        self.duplicates = {} # Export file name to plays skipped as copies of stored plays
+        self._ids = ({}, {}, {}, {}, {})
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.ts)
+
+    def append(self, play):
+        self.ts.append(parse_ts(play["ts"]))
+        self.ms_played.append(play["ms_played"])
+        self.skipped.append(bool(play["skipped"]))
+        self.track.append(self._intern(0, self.tracks, play["master_metadata_track_name"]))
+        self.artist.append(self._intern(1, self.artists, play["master_metadata_album_artist_name"]))
+        self.album.append(self._intern(2, self.albums, play["master_metadata_album_album_name"]))
+        self.uri.append(self._intern(3, self.uris, play["spotify_track_uri"]))
+        self.source.append(self._intern(4, self.sources, play.get("source")))
+        return len(self.ts) - 1
+
+    def pop(self):
+        # Remove the last appended row, leaving its names interned
+        for name in self.COLUMNS:
+            getattr(self, name).pop()
+
+    def _intern(self, column, table, name):
+        ids = self._ids[column]
+        if name not in ids:
+            ids[name] = len(table)
+            table.append(name)
+        return ids[name]
+
+    def thaw(self):
+        # Copy memory mapped snapshot columns into arrays so they can change
+        if self._mmap is None:
+            return
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            thawed = array(column.format)
+            thawed.frombytes(column.cast("B"))
+            column.release()
+            setattr(self, name, thawed)
+        self._ids = tuple({name: i for i, name in enumerate(getattr(self, table))} for table in self.TABLES)
+        self._mmap.close()
+        self._mmap = None
+
+    def drop(self, sources):
+        # Remove every play ingested from the given export files
+        self.thaw()
+        ids = {self._ids[4][source] for source in sources if source in self._ids[4]}
+        keep = [i for i, source in enumerate(self.source) if source not in ids]
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (column[i] for i in keep)))
+        for source in sources:
+            self.manifest.pop(source, None)
+            self.duplicates.pop(source, None)
+
+    def sort(self):
+        # Reorder every column by timestamp, keeping file order for equal timestamps, and return whether any row moved
+        if all(a <= b for a, b in zip(self.ts, self.ts[1:])):
+            return False
+        order = sorted(range(len(self.ts)), key=self.ts.__getitem__)
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (column[i] for i in order)))
+        return True
+
+    def window(self, start, end):
+        # Row range [lo, hi) of plays between two epoch times, inclusive
+        return bisect_left(self.ts, start), bisect_right(self.ts, end)
+
+    def date(self, index):
+        return EPOCH + timedelta(seconds=self.ts[index])
+
+    def track_name(self, index):
+        return self.tracks[self.track[index]]
+
+    def artist_name(self, index):
+        return self.artists[self.artist[index]]
+
+    def album_name(self, index):
+        return self.albums[self.album[index]]
+
+    def track_uri(self, index):
+        return self.uris[self.uri[index]]
+
+class Plays:
+    """Time ordered store rows of one track, artist or album, with running totals."""
+    __slots__ = ("rows", "cum_ms", "tracks")
+
+    def __init__(self, rows=None, cum_ms=None, tracks=0):
+        self.rows = array("l") if rows is None else rows
+        self.cum_ms = array("q", [0]) if cum_ms is None else cum_ms # cum_ms[i] is the time played by the first i rows
+        self.tracks = tracks # Unique tracks, set once grouping finishes
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, index, ms_played):
+        self.rows.append(index)
+        self.cum_ms.append(self.cum_ms[-1] + ms_played)
+
+    @property
+    def ms_played(self):
+        return self.cum_ms[-1]
+
+    @property
+    def first(self):
+        return self.rows[0]
+
+    @property
+    def last(self):
+        return self.rows[-1]
+
+    def span(self, lo, hi):
+        # Positions [start, end) of the rows within store rows [lo, hi), the count being end - start
+        return bisect_left(self.rows, lo), bisect_left(self.rows, hi)
+
+    def unique(self, store, start=0, end=None):
+        return len({store.track[row] for row in self.rows[start:end]})
+
+class PlaySet:
+    """Open addressing set of 64-bit play fingerprints in a single array, zero marking an empty slot."""
+    __slots__ = ("slots", "mask", "size")
+
+    def __init__(self, capacity=0):
+        slots = 1024
+        while slots * 3 < capacity * 4:
+            slots *= 2
+        self.slots = array("Q", bytes(8 * slots))
+        self.mask = slots - 1
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key):
+        # Insert with linear probing, returning False if the key was already in the set
+        key = key & 0xFFFFFFFFFFFFFFFF or 1
+        slots, mask = self.slots, self.mask
+        i = key & mask
+        slot = slots[i]
+        while slot:
+            if slot == key:
+                return False
+            i = (i + 1) & mask
+            slot = slots[i]
+        slots[i] = key
+        self.size += 1
+        # Grow past three quarters full to keep probes short
+        if self.size * 4 > len(slots) * 3:
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self.slots
+        self.slots = slots = array("Q", bytes(16 * len(old)))
+        self.mask = mask = len(slots) - 1
+        for key in old:
+            if key:
+                i = key & mask
+                while slots[i]:
+                    i = (i + 1) & mask
+                slots[i] = key
+
+class SearchIndex:
+    """Casefolded names with n-gram candidate pruning for fuzzy lookups."""
+
+    def __init__(self, keys, names):
+        self.keys = list(keys) # Original keys, returned by extract()
+        self.choices = [normalize(name) for name in names]
+        self.grams = {}
+        for position, choice in enumerate(self.choices):
+            for gram in ngrams(choice):
+                if gram not in self.grams:
+                    self.grams[gram] = array("l")
+                self.grams[gram].append(position)
+
+    def candidates(self, query, positions=None):
+        # Positions sharing the most n-grams with the query, including the padded prefix grams
+        if positions is None and len(self.choices) <= SEARCHCANDIDATES:
+            return range(len(self.choices))
+        if positions is not None and len(positions) <= SEARCHCANDIDATES:
+            return positions
+        allowed = None if positions is None else set(positions)
+        counts = {}
+        for gram in ngrams(query):
+            for position in self.grams.get(gram, ()):
+                counts[position] = counts.get(position, 0) + 1
+        if allowed is not None:
+            counts = {position: count for position, count in counts.items() if position in allowed}
+        return sorted(heapq.nlargest(SEARCHCANDIDATES, counts, key=counts.__getitem__))
+
+    def extract(self, query, scorers, limit=5, score_cutoff=0, positions=None):
+        # Batch score the candidates with each weighted scorer, best matches first
+        with stage("search"):
+            query = normalize(query)
+            candidates = self.candidates(query, positions)
+            choices = [self.choices[position] for position in candidates]
+            scores = [0.0] * len(choices)
+            for scorer, weight in scorers:
+                for _, score, index in process.extract(query, choices, scorer=scorer, processor=None, limit=None):
+                    scores[index] += weight * score
+            best = heapq.nlargest(limit, range(len(choices)), key=scores.__getitem__)
+            return [(self.keys[candidates[index]], scores[index]) for index in best if scores[index] >= score_cutoff]
+
+@dataclass
+class Search:
+    artists: SearchIndex
+    albums: SearchIndex
+    songs: SearchIndex
+    artist_positions: dict # Artist name to positions of their songs in the songs index
+
+    def artist_songs(self, artist):
+        return [self.songs.keys[position] for position in self.artist_positions[artist]]
+
+class MetadataCache:
+    """Spotify track metadata kept in SQLite by track URI, fetched in batches when missing or expired."""
+
+    def __init__(self, path, client=None, ttl=None):
+        self.client = client
+        self.ttl = METADATA_TTL if ttl is None else ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS tracks (uri TEXT PRIMARY KEY, fetched REAL NOT NULL, data TEXT NOT NULL)")
+
+    def track(self, uri):
+        return self.get([uri]).get(uri)
+
+    def get(self, uris):
+        # Metadata of each known URI, requesting missing or expired ones 50 at a time
+        uris = list(dict.fromkeys(uri for uri in uris if uri))
+        now = time.time()
+        tracks = {}
+        with self.lock:
+            for i in range(0, len(uris), 500):
+                chunk = uris[i:i+500]
+                rows = self.db.execute(
+                    f"SELECT uri, data FROM tracks WHERE fetched > ? AND uri IN ({','.join('?' * len(chunk))})",
+                    (now - self.ttl, *chunk)
+                )
+                tracks.update((uri, json.loads(data)) for uri, data in rows)
+
+        missing = [uri for uri in uris if uri not in tracks]
+        client = self.client or spotify_client()
+        for i in range(0, len(missing), MAX_TRACK_IDS):
+            ids = [uri.split(":")[2] for uri in missing[i:i+MAX_TRACK_IDS]]
+            fetched = [track for track in call_api(client.tracks, ids)["tracks"] if track]
+            with self.lock, self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?)",
+                    ((track["uri"], now, json.dumps(track)) for track in fetched)
+                )
+            tracks.update((track["uri"], track) for track in fetched)
+        return tracks
+
+class Cube:
+    """Dense play counts and time played per entity and period."""
+    __slots__ = ("periods", "counts", "ms_played")
+
+    def __init__(self, entities, periods):
+        self.periods = periods
+        self.counts = array("l", [0]) * (entities * periods)
+        self.ms_played = array("q", [0]) * (entities * periods)
+
+    def series(self, entity, start=0, end=None):
+        # (count, ms_played) of one entity for each period in [start, end)
+        base = entity * self.periods
+        end = self.periods if end is None else end
+        return list(zip(self.counts[base + start:base + end], self.ms_played[base + start:base + end]))
+
+    def period(self, period):
+        # (count, ms_played) of every entity in one period
+        return list(zip(self.counts[period::self.periods], self.ms_played[period::self.periods]))
+
+    def fill(self, old):
+        # Copy the cells of a cube with fewer entities or periods, as when new plays add artists or months
+        if old.periods == self.periods:
+            self.counts[:len(old.counts)] = old.counts
+            self.ms_played[:len(old.ms_played)] = old.ms_played
+            return
+        for entity in range(len(old.counts) // old.periods if old.periods else 0):
+            old_base, base = entity * old.periods, entity * self.periods
+            self.counts[base:base + old.periods] = old.counts[old_base:old_base + old.periods]
+            self.ms_played[base:base + old.periods] = old.ms_played[old_base:old_base + old.periods]
+
+@dataclass
+class Rollups:
+    first_month: int # Month number (year * 12 + month - 1) of the first month column
+    months: int
+    cubes: dict # (entity kind, period kind) to Cube, entities being store ids or 0 for "all"
+
+    def month_range(self, start, end):
+        # Month columns covering epoch times [start, end]
+        return max(0, month_number(start) - self.first_month), min(self.months, month_number(end) - self.first_month + 1)
+
+@dataclass
+class Sessions:
+    track_run: tuple # (length, first row, last row) of the longest back to back run
+    artist_run: tuple
+    album_run: tuple
+    count: int
+    seconds: int # Total time spent in sessions
+    plays: int
+    longest: tuple # (seconds, plays, first row, last row)
+
 @dataclass
 class ProcessedData:
+    store: PlayStore
     song_plays: dict
     artist_plays: dict
     album_plays: dict
     skips: dict
     total_time: int
+    plays: Plays
+    song_ids: array
+    rollups: Rollups
+    search: Search = None
+
+class Stage:
+    """Wall time and, while tracemalloc traces, peak allocation of one named stage, added to PROFILE."""
+    __slots__ = ("name", "start", "memory", "start_memory", "peak")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        # Allocation is only followed on the main thread, as the tracemalloc peak is shared by every thread
+        self.memory = tracemalloc.is_tracing() and threading.current_thread() is threading.main_thread()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if STAGES:
+                STAGES[-1].peak = max(STAGES[-1].peak, peak)
+            self.start_memory, self.peak = current, current
+            tracemalloc.reset_peak()
+            STAGES.append(self)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        allocated = 0
+        if self.memory:
+            STAGES.pop()
+            # Outer stages keep the highest peak seen before an inner stage reset it
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if STAGES:
+                STAGES[-1].peak = max(STAGES[-1].peak, self.peak)
+            allocated = self.peak - self.start_memory
+        record_stage(self.name, elapsed, allocated)
+
+@dataclass
+class Query:
+    """One batch query, parsed from a line such as 'tracks results=20 start=2024-01-01'."""
+    text: str
+    cmd: "Cmd"
+    name: str = ""
+    artist: str = ""
+    results: int = 10
+    start: datetime = datetime.min
+    end: datetime = datetime.max
+    shard: str = ""
 
 class Mode(Enum):
     TIME = auto()
@@ -38,9 +436,23 @@ class Cmd(Enum):
     ARTIST = ("artist", Mode.PLAYS)
     SKIPS = ("skips", Mode.PLAYS)
     SUMMARY = ("summary", None)
+    MONTHLY = ("monthly", Mode.TIME)
+    WEEKDAYS = ("weekdays", Mode.TIME)
+    HOURS = ("hours", Mode.TIME)
+    TOPMONTHLY = ("topmonthly", Mode.TIME)
+    REPEATS = ("repeats", None)
+    SESSIONS = ("sessions", None)
     FILTER = ("filter", None)
     RESULT = ("result", None)
     MAKE = ("make", None)
+    PREFETCH = ("prefetch", None)
+    SHARDS = ("shards", None)
+    USE = ("use", None)
+    RELOAD = ("reload", None)
+    MERGED = ("merged", None)
+    OVERLAP = ("overlap", None)
+    STATS = ("stats", None)
+    PROFILE = ("profile", None)
     EXIT = ("exit", None)
     HELP = ("help", None)
 
@@ -60,50 +472,187 @@ DUPLICATES = ["The 1975"] # TODO: Update with spotify API?
 IGNORE = ["Miracle Tones", "Timo Krantz"]
 RESULTS = 10
 ALBUMSLIMIT = 3
+BATCH_CMDS = (
+    Cmd.SUMMARY, Cmd.TRACKS, Cmd.TRACK, Cmd.ARTISTS, Cmd.ARTIST, Cmd.ALBUMS, Cmd.ALBUM, Cmd.SKIPS,
+    Cmd.MONTHLY, Cmd.WEEKDAYS, Cmd.HOURS, Cmd.TOPMONTHLY, Cmd.REPEATS, Cmd.SESSIONS
+)
+RUN_CMDS = {cmd.text for cmd in Cmd} - {
+    Cmd.EXIT.text, Cmd.HELP.text, Cmd.STATS.text, Cmd.PROFILE.text, Cmd.USE.text, Cmd.RELOAD.text
+} # Commands run_cmd handles
+QUERY_OPTIONS = ("results", "start", "end", "artist", "shard") # Written as key=value in batch queries
+SEARCH_QUERIES = ("artist", "album", "track", "monthly", "weekdays", "hours") # Batch queries that may look up a name
+BATCH_DATA = None # Loaded data inherited by forked batch workers
+SOCKET_FILE = ".socket" # Unix socket the query server listens on, in the data folder
+
+# One shard of processed data per export folder given with --data, keyed by folder name
+SHARDS = {}
+SHARD_FOLDERS = {}
+SESSIONGAP = 30 * 60 # Seconds between plays that start a new listening session
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+# Weighted fuzzy scorers for each kind of search
+ARTIST_SCORERS = ((fuzz.ratio, 1),)
+TRACK_SCORERS = ((fuzz.partial_ratio, 1),)
+ALBUM_SCORERS = ((fuzz.partial_ratio, 0.4), (fuzz.token_set_ratio, 0.4), (fuzz.WRatio, 0.2))
+SEARCHCANDIDATES = 2000 # Candidates kept by n-gram pruning before scoring
+
+# Fields of each exported play that are actually read
+FIELDS = (
+    "ts",
+    "ms_played",
+    "skipped",
+    "master_metadata_track_name",
+    "master_metadata_album_artist_name",
+    "master_metadata_album_album_name",
+    "spotify_track_uri",
+)
+
+SPLIT_TOKEN = 16 # Characters from the end of a read buffer where a token cut off by the chunk boundary fails to decode
 
+# Snapshot of the play store kept next to the export files
+SNAPSHOT = ".snapshot"
+SNAPSHOT_MAGIC = b"SPSTATS\0"
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = struct.Struct("<8sII")
+# Groupings saved in the snapshot and the ProcessedData field of each
+AGGREGATES = (("songs", "song_plays"), ("artists", "artist_plays"), ("albums", "album_plays"), ("skips", "skips"))
+
+# Spotify Web API
+SCOPE = "user-library-read playlist-modify-public playlist-modify-private"
+POOLSIZE = 8
+MAX_TRACK_IDS = 50 # Per request to the several tracks endpoint
+MAX_PLAYLIST_URIS = 100 # Per request adding items to a playlist
+PLAYLISTLIMIT = 10000 # Tracks allowed in a made playlist
+API_RETRIES = 5
+API_BACKOFF = 1 # Seconds before the first retry when no Retry-After is sent
+METADATA_FILE = ".metadata.sqlite"
+METADATA_TTL = 7 * 24 * 3600 # Seconds before cached metadata such as popularity is refetched
+API_ERRORS = (spotipy.SpotifyException, SpotifyOauthError, requests.RequestException) # Caught by commands that call the API
+SPOTIFY = None
+METADATA = None
+USER_ID = None
+
+# Stage timings, only recorded with --profile
+PROFILE = None # Stage name to [calls, seconds, largest peak bytes allocated by one call]
+PROFILE_LOCK = threading.Lock()
+PROFILELINES = 15 # Functions and allocation sites shown by the profile command
+STAGES = [] # Open stages tracking allocation, innermost last
+NO_STAGE = nullcontext()
+
+EPOCH = datetime(1970, 1, 1)
+DAYS = {}
+TIMEZONE = None # Zone the month, weekday and hour rollups are bucketed in, None being the system zone
 STARTFILTER = datetime.min
 ENDFILTER = datetime.max
 
-def make_cmd(top_songs):
+def make_cmd(pd, top_songs):
     if not top_songs:
         print("No track list found. Please make a query to get a list.")
-    if len(top_songs) > 1000:
-        print("Number of results exceeds limit (1000 tracks).")
+        return
+    if len(top_songs) > PLAYLISTLIMIT:
+        print(f"Number of results exceeds limit ({PLAYLISTLIMIT} tracks).")
         return
     
     try:
-        load_dotenv()
+        sp = spotify_client()
 
-        sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-            scope="playlist-modify-public playlist-modify-private",
-            client_id=os.getenv("SPOTIFY_CLIENT_ID"),
-            client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
-            redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI")
-        ))
-
-        user_id = sp.current_user()["id"]
-
-        playlist = sp.user_playlist_create(
-            user=user_id,
+        playlist = call_api(
+            sp.user_playlist_create,
+            user=current_user_id(),
             name=f"top {RESULTS}", # TODO: Add artist to name if singular artist
             public=False,
-            description=f"{STARTFILTER.strftime('%d-%m-%Y')} to {ENDFILTER.strftime('%d-%m-%Y')}"
+            description=f"{STARTFILTER.strftime('%d-%m-%Y')} to {ENDFILTER.strftime('%d-%m-%Y')}",
+            idempotent=False
         )
     
         top_song_uris = []
         for item in top_songs:
-            top_song_uris.append(item[1][0]["spotify_track_uri"])
-        
-        MAX_URIS = 100
-        for i in range(0, len(top_song_uris), MAX_URIS):
-            sp.playlist_add_items(
-                playlist_id=playlist["id"],
-                items=top_song_uris[i:i+MAX_URIS]
-            )
+            top_song_uris.append(pd.store.track_uri(item[3]))
+
+        upload_playlist(sp, playlist["id"], top_song_uris)
         print("Successfully created new playlist!")
-    except:
+    except API_ERRORS:
         print("Error creating playlist.")
 
+def upload_playlist(sp, playlist_id, uris):
+    # Spotify applies adds in the order requests arrive, so parallel appends could swap chunks.
+    # Prepending the first half back to front while appending the second half keeps the order
+    # however the two lanes interleave.
+    chunks = [uris[i:i+MAX_PLAYLIST_URIS] for i in range(0, len(uris), MAX_PLAYLIST_URIS)]
+    middle = len(chunks) // 2
+
+    def prepend():
+        for chunk in reversed(chunks[:middle]):
+            call_api(sp.playlist_add_items, playlist_id, chunk, position=0, idempotent=False)
+
+    def append():
+        for chunk in chunks[middle:]:
+            call_api(sp.playlist_add_items, playlist_id, chunk, idempotent=False)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for future in [executor.submit(prepend), executor.submit(append)]:
+            future.result()
+
+def call_api(method, *args, idempotent=True, **kwargs):
+    # Retry rate limited and failing requests, waiting as long as Retry-After asks.
+    # A server error may come after a change was applied, so calls that are not idempotent only retry 429s.
+    for attempt in range(API_RETRIES + 1):
+        try:
+            with stage("API request"):
+                return method(*args, **kwargs)
+        except spotipy.SpotifyException as e:
+            retry = e.http_status == 429 or idempotent and e.http_status >= 500
+            if not retry or attempt == API_RETRIES:
+                raise
+            retry_after = (e.headers or {}).get("Retry-After")
+            time.sleep(float(retry_after) if retry_after else API_BACKOFF * 2 ** attempt)
+
+def current_user_id():
+    global USER_ID
+    if USER_ID is None:
+        USER_ID = call_api(spotify_client().current_user)["id"]
+    return USER_ID
+
+def spotify_client(auth_manager=None):
+    # One client per session, its requests session pools connections to the Web API.
+    # An auth manager can be passed on the first call in place of the OAuth flow, as the stub harness does.
+    global SPOTIFY
+    if SPOTIFY is None:
+        load_dotenv()
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOLSIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        SPOTIFY = spotipy.Spotify(
+            auth_manager=auth_manager or SpotifyOAuth(
+                scope=SCOPE,
+                client_id=os.getenv("SPOTIFY_CLIENT_ID"),
+                client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
+                redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI")
+            ),
+            requests_session=session
+        )
+        # Allows pointing the client at a stand-in for the Web API
+        if os.getenv("SPOTIFY_API_PREFIX"):
+            SPOTIFY.prefix = os.getenv("SPOTIFY_API_PREFIX")
+    return SPOTIFY
+
+def metadata_cache():
+    global METADATA
+    if METADATA is None:
+        METADATA = MetadataCache(data_folder() / METADATA_FILE)
+    return METADATA
+
+def prefetch_cmd(pd, top_songs):
+    if not top_songs:
+        print("No track list found. Please make a query to get a list.")
+        return
+    try:
+        tracks = metadata_cache().get([pd.store.track_uri(item[3]) for item in top_songs])
+        print(f"Cached metadata for {len(tracks)} track(s).")
+    except API_ERRORS as e:
+        print(f"Error fetching track metadata: {e}")
+
 def result_cmd():
     global RESULTS
     number = input("How many results? ")
@@ -144,40 +693,35 @@ def filter_cmd():
 
 def artist_cmd(pd):
     artist_name = input("Which artist? ")
-    match_list = difflib.get_close_matches(artist_name, (key.lower() for key in pd.artist_plays.keys()), n=1, cutoff=0.5)
+    search = search_index(pd)
+    match_list = search.artists.extract(artist_name, ARTIST_SCORERS, limit=1, score_cutoff=50)
     if not match_list:
         print("Could not find artist.")
         return
-    match_list = [key for key in pd.artist_plays if key.lower() in match_list]
-    artist_song_plays = {song: plays for song, plays in pd.song_plays.items() if song[1] == match_list[0]}
-    return print_object(Cmd.TRACKS, artist_song_plays)
+    artist_song_plays = {song: pd.song_plays[song] for song in search.artist_songs(match_list[0][0])}
+    return print_object(Cmd.TRACKS, artist_song_plays, pd.store)
 
 def track_cmd(pd):
     track_name = input("What track? ")
     artist_name = input("By which artist? ")
+    search = search_index(pd)
 
     # Search by artist
-    match_list = difflib.get_close_matches( # TODO: Change to RapidFuzz?
-        artist_name, 
-        (artist for artist in pd.artist_plays.keys()),
-        n=1, 
-        cutoff=0.5
-    )
+    match_list = search.artists.extract(artist_name, ARTIST_SCORERS, limit=1, score_cutoff=50)
     if not match_list:
         print("Could not find artist. Please try again.")
         return
-    artist_name = match_list[0]
-    artist_song_plays = {song: plays for song, plays in pd.song_plays.items() if song[1] == artist_name}
+    artist_name = match_list[0][0]
 
     # Search by tracks for that artist
-    track_match_list = process.extract( # TODO: Create search helper function?
-        track_name.lower(),
-        (song[0].lower() for song in artist_song_plays.keys()), # TODO: Convert to list beforehand?
-        scorer=fuzz.partial_ratio,
-        limit=5
+    track_match_list = search.songs.extract(
+        track_name,
+        TRACK_SCORERS,
+        limit=5,
+        score_cutoff=80,
+        positions=search.artist_positions[artist_name]
     )
-    song_key_list = list(artist_song_plays.keys())
-    song_match_list = [song_key_list[match[2]] for match in track_match_list if match[1] >= 80]
+    song_match_list = [match[0] for match in track_match_list]
 
     if len(song_match_list) <= 0:
         print("Could not find song. Please check your spelling and try again.")
@@ -196,38 +740,53 @@ def track_cmd(pd):
             number = int(input("Invalid number. Please try again."))
 
     song = song_match_list[number-1]
-    print_object(Cmd.TRACK, {song: pd.song_plays[song]})
-
-def custom_score(query, choice, **kwargs):
-        return (0.4 * fuzz.partial_ratio(query, choice) + 0.4 * fuzz.token_set_ratio(query, choice) + 0.2 * fuzz.WRatio(query, choice))
+    print_object(Cmd.TRACK, {song: pd.song_plays[song]}, pd.store)
 
 def album_cmd(pd):
     album_name = input("Which album? ")
 
-    album_match_list = process.extract(
-        album_name.lower(),
-        (album.lower() for album in pd.album_plays.keys()),
-        scorer=custom_score,
-        limit=5
-    )
+    album_match_list = search_index(pd).albums.extract(album_name, ALBUM_SCORERS, limit=5)
     if not album_match_list:
         print("Could not find album. Please check spelling and try again.")
         return
     print(album_match_list)
-    index = album_match_list[0][2]
-    album = list(pd.album_plays)[index]
+    album = album_match_list[0][0]
+    return print_object(Cmd.TRACKS, album_songs(pd, album), pd.store)
 
+def album_songs(pd, album):
     album_song_plays = {}
-    for play in pd.album_plays[album]:
-        artist = play["master_metadata_album_artist_name"]
-        track = play["master_metadata_track_name"]
+    for play in pd.album_plays[album].rows:
+        artist = pd.store.artist_name(play)
+        track = pd.store.track_name(play)
 
         song = (track, artist) # TODO: Artist potentially not needed?
         if song not in album_song_plays:
-            album_song_plays[song] = []
-        album_song_plays[song].append(play)
+            album_song_plays[song] = Plays()
+        album_song_plays[song].append(play, pd.store.ms_played[play])
+    return album_song_plays
+
+def search_index(pd):
+    # Built on first use and kept for the rest of the session
+    if pd.search is None:
+        with stage("search index"):
+            songs = SearchIndex(pd.song_plays, (song[0] for song in pd.song_plays))
+            artist_positions = {artist: array("l") for artist in pd.artist_plays}
+            for position, song in enumerate(songs.keys):
+                artist_positions.setdefault(song[1], array("l")).append(position)
+            pd.search = Search(
+                SearchIndex(pd.artist_plays, pd.artist_plays),
+                SearchIndex(pd.album_plays, pd.album_plays),
+                songs,
+                artist_positions
+            )
+    return pd.search
+
+def normalize(name):
+    return (name or "").casefold().strip()
 
-    print_object(Cmd.TRACKS, album_song_plays)
+def ngrams(text, n=3):
+    padded = f"{' ' * (n - 1)}{text} "
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
 
 def help_cmd():
     print("Commands:")
@@ -239,14 +798,47 @@ def help_cmd():
     print("album - Show data for a specific album")
     print("albums - Show your top albums")
     print("skip - Show your most skipped songs")
+    print("monthly - Show listening per month for all or one artist")
+    print("weekdays - Show listening per day of the week for all or one artist")
+    print("hours - Show listening per hour of the day for all or one artist")
+    print("topmonthly - Show your top artists or albums for each month")
+    print("repeats - Show the longest runs of the same track, artist and album")
+    print("sessions - Show your listening sessions")
     print("filter - Sets filters for results")
     print("help - Shows this list of commands")
     print("make - Make a spotify playlist based on the previous track or specific artist query")
+    print("prefetch - Cache Spotify metadata for the tracks of the previous query")
+    print("shards - List the loaded export folders")
+    print("use - Switch to the data of another export folder")
+    print("reload - Reload a shard by name, or every shard whose export files changed")
+    print("merged - Show top artists, albums or tracks across every shard")
+    print("overlap - Show the artists, albums or tracks two shards share")
+    print("stats - Show time spent in each stage with --profile, 'stats reset' clears it")
+    print("profile - Run one command under cProfile and tracemalloc and save both")
     print("exit - Exit the program")
 
 def main(args):
-    data = parse_data()
-    pd = process_data(args, data)
+    if args.profile:
+        start_profile(args.profile)
+    set_timezone(args.tz)
+
+    if args.serve:
+        pd = load_shards(args)
+        serve(pd, Path(args.socket) if args.socket else data_folder() / SOCKET_FILE)
+        return
+
+    queries = batch_queries(args)
+    if queries:
+        # Results alone go to stdout so they can be piped, loading progress goes to stderr
+        with redirect_stdout(sys.stderr):
+            pd = load_shards(args)
+        write_results(run_batch(pd, queries, args.workers), args.format, sys.stdout)
+        if PROFILE is not None:
+            with redirect_stdout(sys.stderr):
+                stats_cmd()
+        return
+
+    pd = load_shards(args)
     
     # Setup command history
     history_file = os.path.expanduser("~/.history_file")
@@ -256,7 +848,8 @@ def main(args):
         pass
     atexit.register(readline.write_history_file, history_file)
 
-    global RESULTS, STARTFILTER, ENDFILTER
+    global RESULTS, STARTFILTER, ENDFILTER, PLAYLISTLIMIT
+    PLAYLISTLIMIT = args.playlist_limit
     top_songs = None
     
     # Process commands
@@ -266,33 +859,24 @@ def main(args):
             msg = msg.split(" ", maxsplit=1)
             cmd = msg[0]
             match cmd:
-                case Cmd.MAKE.text:
-                    make_cmd(top_songs)
-                case Cmd.RESULT.text:
-                    result_cmd()
-                case Cmd.FILTER.text:
-                    filter_cmd()
-                case Cmd.SUMMARY.text:
-                    print_summary(pd)
-                case Cmd.ARTISTS.text:
-                    print_object(Cmd.ARTISTS, pd.artist_plays)
-                case Cmd.ARTIST.text:
-                    top_songs = artist_cmd(pd)
-                case Cmd.TRACKS.text:
-                    print_object(Cmd.TRACKS, pd.song_plays)
-                case Cmd.TRACK.text:
-                    track_cmd(pd)
-                case Cmd.ALBUMS.text:
-                    print_object(Cmd.ALBUMS, pd.album_plays)
-                case Cmd.ALBUM.text:
-                    album_cmd(pd)
-                case Cmd.SKIPS.text:
-                    print_object(Cmd.SKIPS, pd.skips)
                 case Cmd.EXIT.text:
                     print("Exiting program...")
                     break
                 case Cmd.HELP.text:
                     help_cmd()
+                case Cmd.STATS.text:
+                    stats_cmd(msg[1] if len(msg) > 1 else "")
+                case Cmd.PROFILE.text:
+                    top_songs = profile_cmd(pd, top_songs)
+                case Cmd.USE.text | Cmd.RELOAD.text:
+                    name = msg[1].strip() if len(msg) > 1 else ""
+                    shard = use_cmd(pd, name) if cmd == Cmd.USE.text else reload_cmd(args, pd, name)
+                    # The previous track list points into the old shard's store
+                    if shard is not pd:
+                        pd, top_songs = shard, None
+                case _ if cmd in RUN_CMDS:
+                    with stage(f"command {cmd}"):
+                        top_songs = run_cmd(pd, cmd, top_songs)
                 case _:
                     print("Unknown command. Type 'help' for a list of commands.") 
                     continue
@@ -307,69 +891,39 @@ def print_summary(pd):
     print(f"Unique artists played: {len(pd.artist_plays.keys())}")
     print(f"Total time: {pd.total_time // 3600000} hours")
 
-def print_object(cmd, object_plays, sp=None):
+def print_object(cmd, object_plays, store, sp=None):
     print("=" * shutil.get_terminal_size().columns)
-    # Filter object plays and remove keys with no valid filtered results
-    object_plays = {
-        obj: filtered
-        for obj, plays in object_plays.items()
-        if (filtered := [play for play in plays if STARTFILTER <= date(play) <= ENDFILTER])
-    }
-    if not object_plays:
+    top_objects, top_results = rank_objects(cmd, object_plays, store, *store.window(epoch(STARTFILTER), epoch(ENDFILTER)), RESULTS)
+    if not top_objects:
         print("No plays found.")
         return
 
-    # Filter albums and remove those with less than ALBUMSLIMIT number of unique songs
-    if cmd == Cmd.ALBUMS:
-        object_plays = {
-            obj: plays
-            for obj, plays in object_plays.items()
-            if len({play["master_metadata_track_name"] for play in plays}) >= ALBUMSLIMIT
-        }
-
-    # Sort top objects based on current mode
-    if cmd.mode == Mode.PLAYS:
-        top_objects = sorted(object_plays.items(), key=lambda item: len(item[1]), reverse=True)
-    elif cmd.mode == Mode.TIME:
-        top_objects = sorted(object_plays.items(), key=lambda item: sum(play["ms_played"] for play in item[1]), reverse=True)
-    
-    # Get all plays and first play
-    all_plays = list(chain.from_iterable(object_plays.values()))
-    first_play = min(all_plays, key=lambda play: datetime.strptime(play["ts"], "%Y-%m-%dT%H:%M:%SZ")) 
-    first_play_track = first_play["master_metadata_track_name"]
-    first_play_artist = first_play["master_metadata_album_artist_name"]
-    first_play_date = datetime.strptime(first_play["ts"], "%Y-%m-%dT%H:%M:%SZ").strftime("%-d %B, %Y")
-
-    if cmd == Cmd.TRACK:
-        sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-            scope="user-library-read",
-            client_id=os.getenv("SPOTIFY_CLIENT_ID"),
-            client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
-            redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI")
-        ))
-
-        uri = all_plays[0]["spotify_track_uri"]
-        id = uri.split(":")[2]
-        song = sp.track(id)
-        print(f"Popularity: {song['popularity']} / 100")
-
-    # TODO: Create get_object() helper function that gets artist / album / track name based on current cmd?
     if cmd == Cmd.TRACK:
+        # A single song, and its plays are in time order, so its first row in the window is its first play
+        first_play = top_objects[0][3]
+        first_play_track = store.track_name(first_play)
+        first_play_artist = store.artist_name(first_play)
+        first_play_date = store.date(first_play).strftime("%-d %B, %Y")
+
+        try:
+            song = metadata_cache().track(store.track_uri(first_play))
+            if song:
+                print(f"Popularity: {song['popularity']} / 100")
+        except API_ERRORS as e:
+            print(f"Error fetching track metadata: {e}")
+
+        # TODO: Create get_object() helper function that gets artist / album / track name based on current cmd?
         print(f"First played {first_play_track} by {first_play_artist} on {first_play_date}")
 
-    print(f"Total: {sum(len(plays) for plays in object_plays.values())} {'skip' if cmd == Cmd.SKIPS else 'play'}(s)")
+    print(f"Total: {sum(row[1] for row in top_objects)} {'skip' if cmd == Cmd.SKIPS else 'play'}(s)")
     if cmd != Cmd.TRACK:
-        print(f"Unique: {len(object_plays.keys())} {cmd.text}(s)")
+        print(f"Unique: {len(top_objects)} {cmd.text}(s)")
         print(f"Top {cmd.text}(s):")
-        for i in range(min(RESULTS, len(top_objects))):
-            object = top_objects[i][0]
-            plays = top_objects[i][1]
-            first_play = min(top_objects[i][1], key=lambda play: date(play))
-            first_play_track = first_play["master_metadata_track_name"]
-            first_play_date = date(first_play).strftime("%-d %B, %Y")
+        for i, (object, count, play_time, first_play) in enumerate(top_results):
+            first_play_track = store.track_name(first_play)
+            first_play_date = store.date(first_play).strftime("%-d %B, %Y")
 
             # TODO: Remove first play if STARTFILTER is adjusted?
-            play_time = sum(play["ms_played"] for play in top_objects[i][1])
             play_hours = play_time // 3600000
             play_mins = (play_time // 60000) % 60
 
@@ -378,92 +932,1177 @@ def print_object(cmd, object_plays, sp=None):
                 result = f"{i+1}. {object[0]} by {object[1]}"
             else:
                 result = f"{i+1}. {object}"
-            result += f", played {len(plays)} times for {play_hours} hours {play_mins} minutes, first played" 
+            result += f", played {count} times for {play_hours} hours {play_mins} minutes, first played" 
             if cmd != Cmd.TRACKS:
                 result += f" {first_play_track}"
             result += f" on {first_play_date}"
             print(result)
-        return top_objects[:RESULTS]
-
-def parse_data():
-    folder = Path(".data")
-    data = []
-    for file in folder.iterdir():
-        if file.is_file() and file.suffix == ".json":
-            with open(file, "r") as f:
+        return top_results
+
+def rank_objects(cmd, object_plays, store, lo, hi, results):
+    # Aggregate each key over the rows [lo, hi) with prefix sums, dropping keys with no plays in it
+    filtered = lo > 0 or hi < len(store)
+    top_objects = []
+    with stage("filter"):
+        for obj, plays in object_plays.items():
+            start, end = plays.span(lo, hi) if filtered else (0, len(plays))
+            if start == end:
+                continue
+            # Remove albums with less than ALBUMSLIMIT number of unique songs
+            if cmd == Cmd.ALBUMS and (plays.tracks < ALBUMSLIMIT or filtered and plays.unique(store, start, end) < ALBUMSLIMIT):
+                continue
+            top_objects.append((obj, end - start, plays.cum_ms[end] - plays.cum_ms[start], plays.rows[start]))
+
+    # Select top objects based on current mode
+    top_results = []
+    with stage("sort"):
+        if cmd.mode == Mode.PLAYS:
+            top_results = top_k(top_objects, results, key=itemgetter(1))
+        elif cmd.mode == Mode.TIME:
+            top_results = top_k(top_objects, results, key=itemgetter(2))
+    return top_objects, top_results
+
+def top_k(rows, k, key):
+    # Largest k rows by key, ties kept in row order as with a stable sort
+    # The heap only beats a full sort when k is a small fraction of the rows
+    if k * 64 >= len(rows):
+        return sorted(rows, key=key, reverse=True)[:k]
+    return heapq.nlargest(k, rows, key=key)
+
+def shards_cmd(pd):
+    for name, shard in SHARDS.items():
+        print(f"{name}: {len(shard.store)} plays from {SHARD_FOLDERS[name]}{' (in use)' if shard is pd else ''}")
+
+def use_cmd(pd, name=""):
+    name = name or input("Which shard? ").strip()
+    if name not in SHARDS:
+        print(f"Unknown shard. Shards: {', '.join(SHARDS)}")
+        return pd
+    print(f"Using shard {name}: {len(SHARDS[name].store)} plays")
+    return SHARDS[name]
+
+def reload_cmd(args, pd, name=""):
+    # Reload one shard, or every shard whose export files changed, re-ingesting only changed files
+    if name and name not in SHARDS:
+        print(f"Unknown shard. Shards: {', '.join(SHARDS)}")
+        return pd
+    names = [name] if name else [name for name, shard in SHARDS.items() if export_files(SHARD_FOLDERS[name])[1] != shard.store.manifest]
+    if not names:
+        print("Every shard is up to date.")
+    reload_args = argparse.Namespace(**{**vars(args), "rebuild_cache": False})
+    for name in names:
+        current = SHARDS[name] is pd
+        SHARDS[name] = load_data(reload_args, SHARD_FOLDERS[name])
+        if current:
+            pd = SHARDS[name]
+        print(f"Reloaded shard {name}: {len(SHARDS[name].store)} plays")
+    return pd
+
+def shard_objects(cmd, pd, startfilter, endfilter):
+    # Per key totals of one shard over the filter window, from its aggregates rather than its plays
+    object_plays = {Cmd.ARTISTS: pd.artist_plays, Cmd.ALBUMS: pd.album_plays, Cmd.TRACKS: pd.song_plays}[cmd]
+    top_objects, _ = rank_objects(cmd, object_plays, pd.store, *pd.store.window(epoch(startfilter), epoch(endfilter)), 0)
+    return {obj: (count, play_time) for obj, count, play_time, _ in top_objects}
+
+def merge_shards(cmd, shards, startfilter, endfilter):
+    totals = {}
+    for pd in shards:
+        for obj, (count, play_time) in shard_objects(cmd, pd, startfilter, endfilter).items():
+            total = totals.get(obj)
+            if total is None:
+                totals[obj] = [count, play_time, 1]
+            else:
+                total[0] += count
+                total[1] += play_time
+                total[2] += 1
+    return [(obj, count, play_time, users) for obj, (count, play_time, users) in totals.items()]
+
+def shard_cmd_kind():
+    kind = input("Artists, albums or tracks? ").strip().lower()
+    if kind.startswith("album"):
+        return Cmd.ALBUMS
+    if kind.startswith("track"):
+        return Cmd.TRACKS
+    return Cmd.ARTISTS
+
+def object_name(cmd, obj):
+    return f"{obj[0]} by {obj[1]}" if cmd == Cmd.TRACKS else obj
+
+def merged_cmd():
+    if len(SHARDS) < 2:
+        print("Only one export is loaded. Pass --data once for each export folder.")
+        return
+    cmd = shard_cmd_kind()
+    print("=" * shutil.get_terminal_size().columns)
+    merged = merge_shards(cmd, SHARDS.values(), STARTFILTER, ENDFILTER)
+    if not merged:
+        print("No plays found.")
+        return
+    print(f"Top {cmd.text}(s) across {len(SHARDS)} shards:")
+    key = itemgetter(2) if cmd.mode == Mode.TIME else itemgetter(1)
+    for i, (obj, count, play_time, users) in enumerate(top_k(merged, RESULTS, key=key)):
+        print(f"{i+1}. {object_name(cmd, obj)}, played {count} times for {play_time // 3600000} hours {(play_time // 60000) % 60} minutes by {users} of {len(SHARDS)}")
+
+def overlap_cmd():
+    if len(SHARDS) < 2:
+        print("Only one export is loaded. Pass --data once for each export folder.")
+        return
+    first = input("First shard? ").strip()
+    second = input("Second shard? ").strip()
+    if first not in SHARDS or second not in SHARDS:
+        print(f"Unknown shard. Shards: {', '.join(SHARDS)}")
+        return
+    cmd = shard_cmd_kind()
+    print("=" * shutil.get_terminal_size().columns)
+    a = shard_objects(cmd, SHARDS[first], STARTFILTER, ENDFILTER)
+    b = shard_objects(cmd, SHARDS[second], STARTFILTER, ENDFILTER)
+    shared = [(obj, a[obj][0], b[obj][0]) for obj in a.keys() & b.keys()]
+    union = len(a) + len(b) - len(shared)
+    print(f"Shared {cmd.text}(s): {len(shared)} of {len(a)} for {first} and {len(b)} for {second} ({len(shared) / union if union else 0:.0%} overlap)")
+    # Most shared first, by the smaller of the two play counts
+    for i, (obj, count_a, count_b) in enumerate(top_k(shared, RESULTS, key=lambda row: (min(row[1], row[2]), row[1] + row[2]))):
+        print(f"{i+1}. {object_name(cmd, obj)}, played {count_a} times by {first} and {count_b} times by {second}")
+
+def load_shards(args):
+    # Each export folder becomes its own shard with its own snapshot, returning the first
+    folders = [Path(folder) for folder in args.data]
+    names = [folder.resolve().name for folder in folders]
+    if len(set(names)) < len(names):
+        names = [str(folder) for folder in folders]
+    SHARD_FOLDERS.update(zip(names, folders))
+    if len(folders) == 1:
+        SHARDS[names[0]] = load_data(args, folders[0])
+        return SHARDS[names[0]]
+
+    # Ingest the folders in parallel processes, splitting the parse workers between them
+    shard_args = argparse.Namespace(**{**vars(args), "workers": max(1, args.workers // len(folders))})
+    with ProcessPoolExecutor(max_workers=min(max(args.workers, 1), len(folders))) as executor:
+        SHARDS.update(zip(names, executor.map(load_shard, repeat(shard_args), folders)))
+    for name, pd in SHARDS.items():
+        print(f"Shard {name}: {len(pd.store)} plays")
+    print(f"Using shard {names[0]}. Type 'use' to switch.")
+    return SHARDS[names[0]]
+
+def load_shard(args, folder):
+    # Spawned workers do not inherit the zone main() set
+    set_timezone(args.tz)
+    pd = load_data(args, folder)
+    # Snapshot columns are views of a memory map, which cannot be sent back to the parent process
+    pd.store.thaw()
+    return pd
+
+def data_folder():
+    # Files shared by every shard, such as the metadata cache, go in the first folder given with --data
+    return next(iter(SHARD_FOLDERS.values()), Path(".data"))
+
+def export_files(folder):
+    files = sorted(file for file in folder.iterdir() if file.is_file() and file.suffix == ".json")
+    return files, {file.name: [file.stat().st_size, file.stat().st_mtime_ns] for file in files}
+
+def load_data(args, folder=Path(".data")):
+    files, manifest = export_files(folder)
+    snapshot = folder / SNAPSHOT
+
+    with stage("snapshot read"):
+        store, pd = (None, None) if args.rebuild_cache else read_snapshot(snapshot)
+    if store is None:
+        store = PlayStore()
+    else:
+        print(f"Loaded {len(store)} plays from {snapshot.name}")
+
+    # Only ingest export files that are new or changed since the snapshot was written
+    stale = [name for name, stat in store.manifest.items() if manifest.get(name) != stat]
+    # Files that failed to parse kept their plays up to the error but stayed out of the manifest, so parse them again
+    stale += [file.name for file in files if file.name not in store.manifest and file.name in store.sources]
+    # Plays skipped from other files may have been copies of plays in a stale file, and only a full rebuild restores them
+    if stale and any(source not in stale for source in store.duplicates):
+        print("Export files changed after duplicate plays were skipped, re-ingesting every file")
+        store, pd = PlayStore(), None
+        stale = []
+    if stale:
+        # Dropping rows moves the ones after them, so the saved aggregates no longer apply
+        store.drop(stale)
+        pd = None
+    pending = [file for file in files if file.name not in store.manifest]
+
+    if pending or stale:
+        failed = set()
+        with stage("process_data"):
+            pd = process_data(args, parse_data(args, pending, failed), store, pd)
+        for name in sorted(failed):
+            print(f"{name} will be parsed again on the next start")
+        store.manifest.update((file.name, manifest[file.name]) for file in pending if file.name not in failed)
+    elif pd is not None:
+        return pd
+    else:
+        # The snapshot was written with other grouping settings, such as another time zone
+        with stage("aggregate"):
+            pd = group_plays(store)
+    try:
+        with stage("snapshot write"):
+            write_snapshot(snapshot, pd)
+    except OSError as e:
+        print(f"Could not write {snapshot.name}: {e}")
+    return pd
+
+def read_snapshot(path):
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None, None
+    except (OSError, ValueError) as e:
+        print(f"Discarding {path.name}: {e}")
+        return None, None
+
+    store = None
+    try:
+        magic, version, header_size = SNAPSHOT_HEADER.unpack_from(mm)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a snapshot file")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"version {version} is not {SNAPSHOT_VERSION}")
+        header = json.loads(mm[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + header_size])
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("written on a machine with a different byte order")
+
+        store = PlayStore()
+        store.manifest = header["manifest"]
+        store.duplicates = header["duplicates"]
+        for table in PlayStore.TABLES:
+            setattr(store, table, header[table])
+        # Check every column fits before viewing any, as the map cannot close while views are held
+        start = SNAPSHOT_HEADER.size + header_size
+        columns = []
+        for name, typecode, offset, count in header["columns"]:
+            if name in PlayStore.COLUMNS and count != header["rows"]:
+                raise ValueError(f"column {name} has {count} of {header['rows']} rows")
+            size = count * array(typecode).itemsize
+            offset += start
+            if size < 0 or offset < start or offset + size > len(mm):
+                raise ValueError("file is truncated")
+            columns.append((name, typecode, offset, size))
+        missing = set(PlayStore.COLUMNS) - {name for name, *_ in columns}
+        if missing:
+            raise ValueError(f"missing columns {', '.join(sorted(missing))}")
+
+        # Store columns are views into the mapped file until the store is thawed,
+        # aggregate arrays are copied out as new plays are appended to them
+        arrays = {}
+        for name, typecode, offset, size in columns:
+            if name in PlayStore.COLUMNS:
+                setattr(store, name, memoryview(mm)[offset:offset + size].cast(typecode))
+            else:
+                arrays[name] = array(typecode)
+                arrays[name].frombytes(mm[offset:offset + size])
+        store._mmap = mm
+        return store, restore_aggregates(store, header["aggregates"], arrays)
+    except (ValueError, KeyError, TypeError, IndexError, struct.error) as e:
+        # Release any views already made so the map can close
+        for name in PlayStore.COLUMNS:
+            column = getattr(store, name, None)
+            if isinstance(column, memoryview):
+                column.release()
+        mm.close()
+        print(f"Discarding {path.name}: {e}")
+        return None, None
+
+def write_snapshot(path, pd):
+    # Columns must be arrays to be written, and the mapped file is about to be replaced
+    store = pd.store
+    store.thaw()
+    arrays = {name: getattr(store, name) for name in PlayStore.COLUMNS}
+    arrays.update(aggregate_arrays(pd))
+    columns = []
+    offset = 0
+    for name, column in arrays.items():
+        columns.append((name, column.typecode, offset, len(column)))
+        offset += len(column) * column.itemsize
+    header = json.dumps({
+        "byteorder": sys.byteorder,
+        "rows": len(store),
+        "manifest": store.manifest,
+        "duplicates": store.duplicates,
+        "columns": columns,
+        "aggregates": {
+            "settings": grouping_settings(),
+            "total_time": pd.total_time,
+            "first_month": pd.rollups.first_month,
+            "months": pd.rollups.months
+        },
+        **{table: getattr(store, table) for table in PlayStore.TABLES},
+    }).encode()
+    # Pad the header so the columns after it stay aligned
+    header += b" " * (-(SNAPSHOT_HEADER.size + len(header)) % 8)
+
+    # Write beside the old snapshot and swap it in so a crash never leaves a partial file
+    temp = path.with_suffix(".tmp")
+    with open(temp, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+        f.write(header)
+        for column in arrays.values():
+            f.write(column)
+    os.replace(temp, path)
+
+def aggregate_arrays(pd):
+    # Each grouping is saved as its Plays concatenated, with offsets to where each starts
+    arrays = {}
+    for name, field in AGGREGATES:
+        groups = getattr(pd, field).values()
+        rows, cum_ms = array("l"), array("q")
+        for group in groups:
+            rows.extend(group.rows)
+            cum_ms.extend(group.cum_ms)
+        arrays[f"{name}.offsets"] = array("q", accumulate((len(group) for group in groups), initial=0))
+        arrays[f"{name}.rows"] = rows
+        arrays[f"{name}.cum_ms"] = cum_ms
+        arrays[f"{name}.tracks"] = array("l", (group.tracks for group in groups))
+    arrays["plays.rows"] = pd.plays.rows
+    arrays["plays.cum_ms"] = pd.plays.cum_ms
+    arrays["song_ids"] = pd.song_ids
+    for (entity, period), cube in pd.rollups.cubes.items():
+        arrays[f"cube.{entity}.{period}.counts"] = cube.counts
+        arrays[f"cube.{entity}.{period}.ms_played"] = cube.ms_played
+    return arrays
+
+def restore_aggregates(store, meta, arrays):
+    # Rebuild ProcessedData from saved arrays, or None if they were grouped with other settings
+    if meta["settings"] != grouping_settings():
+        return None
+    groupings = {}
+    for name, field in AGGREGATES:
+        offsets, rows, cum_ms, tracks = (arrays[f"{name}.{part}"] for part in ("offsets", "rows", "cum_ms", "tracks"))
+        if len(offsets) != len(tracks) + 1 or offsets[-1] != len(rows) or len(cum_ms) != len(rows) + len(tracks):
+            raise ValueError(f"{name} do not match their rows")
+        groups = {}
+        for i in range(len(tracks)):
+            start, end = offsets[i], offsets[i + 1]
+            # Every row of a group shares its key, so the first one gives it
+            first = rows[start]
+            if name == "artists":
+                key = store.artist_name(first)
+            elif name == "albums":
+                key = store.album_name(first)
+            else:
+                key = song_key(store.track_name(first), store.artist_name(first), store.album_name(first))
+            groups[key] = Plays(rows[start:end], cum_ms[start + i:end + i + 1], tracks[i])
+        groupings[field] = groups
+
+    cubes = {}
+    for (entity, period), entities, periods in rollup_shapes(store, meta["months"]):
+        cube = cubes[entity, period] = Cube(0, periods)
+        cube.counts = arrays[f"cube.{entity}.{period}.counts"]
+        cube.ms_played = arrays[f"cube.{entity}.{period}.ms_played"]
+        if len(cube.counts) != entities * periods or len(cube.ms_played) != entities * periods:
+            raise ValueError(f"{entity} {period} rollup does not match its shape")
+
+    plays = Plays(arrays["plays.rows"], arrays["plays.cum_ms"])
+    return ProcessedData(
+        store, groupings["song_plays"], groupings["artist_plays"], groupings["album_plays"], groupings["skips"],
+        meta["total_time"], plays, arrays["song_ids"], Rollups(meta["first_month"], meta["months"], cubes)
+    )
+
+def grouping_settings():
+    # Everything besides the plays that the aggregates depend on
+    return {"duplicates": DUPLICATES, "ignore": IGNORE, "timezone": timezone_key()}
+
+def parse_data(args, files, failed=None):
+    # Names of files that could not be parsed to the end are added to failed
+    workers = min(args.workers, len(files))
+
+    if workers <= 1:
+        # Stream records straight from each file without collecting them
+        for file in files:
+            start = time.perf_counter()
+            count = 0
+            for record in iter_records(file, failed):
+                count += 1
+                yield record
+            elapsed = time.perf_counter() - start
+            print(f"Parsed {file.name}: {count} plays in {elapsed:.2f}s")
+            # Streamed parsing includes the time the consumer spends on each record
+            if PROFILE is not None:
+                record_stage("file parse", elapsed)
+        return
+
+    # Spread files across a process pool, keeping file order for deterministic results.
+    # Only one file per worker is in flight, the next being submitted as each is consumed,
+    # so finished files never pile up in the parent ahead of the consumer.
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = iter(files)
+        futures = deque(executor.submit(parse_file, file) for file in islice(pending, workers))
+        while futures:
+            name, records, elapsed, ok = futures.popleft().result()
+            if not ok and failed is not None:
+                failed.add(name)
+            for file in islice(pending, 1):
+                futures.append(executor.submit(parse_file, file))
+            print(f"Parsed {name}: {len(records)} plays in {elapsed:.2f}s")
+            if PROFILE is not None:
+                record_stage("file parse", elapsed)
+            yield from records
+            del records
+
+def parse_file(file):
+    start = time.perf_counter()
+    failed = set()
+    records = list(iter_records(file, failed))
+    return file.name, records, time.perf_counter() - start, not failed
+
+def iter_records(file, failed=None, chunk_size=1 << 16):
+    # Incrementally decode a JSON list of plays, keeping only the fields that are read
+    decoder = json.JSONDecoder()
+    try:
+        with open(file, "r", encoding="utf-8") as f:
+            buffer = f.read(chunk_size)
+            pos = _skip_whitespace(buffer, 0)
+            if pos >= len(buffer) or buffer[pos] != "[":
+                return
+            pos += 1
+            while True:
+                pos = _skip_whitespace(buffer, pos, ",")
+                if pos >= len(buffer):
+                    more = f.read(chunk_size)
+                    if not more:
+                        raise json.JSONDecodeError("Unterminated list", buffer, pos)
+                    buffer = buffer[pos:] + more
+                    pos = 0
+                    continue
+                if buffer[pos] == "]":
+                    return
                 try:
-                    parsed_data = json.load(f)
-                    if isinstance(parsed_data, list):
-                        data.extend(parsed_data)
+                    play, end = decoder.raw_decode(buffer, pos)
                 except json.JSONDecodeError as e:
-                    print(f"Error parsing {file.name}: {e}")
-                except Exception as e:
-                    print(f"Unexpected error with {file.name}: {e}")
-    return data
+                    # An object split across chunks fails at the end of the buffer, or inside a string running to it.
+                    # Errors anywhere else are malformed input, which more data cannot fix.
+                    if len(buffer) - e.pos > SPLIT_TOKEN and not e.msg.startswith("Unterminated string"):
+                        raise
+                    more = f.read(chunk_size)
+                    if not more:
+                        raise
+                    buffer = buffer[pos:] + more
+                    pos = 0
+                    continue
+                pos = end
+                if isinstance(play, dict) and play.get("master_metadata_track_name") is not None:
+                    record = {field: play.get(field) for field in FIELDS}
+                    record["source"] = file.name
+                    yield record
+    except Exception as e:
+        if isinstance(e, json.JSONDecodeError):
+            print(f"Error parsing {file.name}: {e}")
+        else:
+            print(f"Unexpected error with {file.name}: {e}")
+        if failed is not None:
+            failed.add(file.name)
 
-def process_data(args, data):
+def _skip_whitespace(buffer, pos, extra=""):
+    while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in extra):
+        pos += 1
+    return pos
+
+def process_data(args, data, store=None, pd=None):
+    # New plays are merged into the aggregates of pd when given, if they all come after the stored ones
     global STARTFILTER, ENDFILTER
-    song_plays = {}
-    artist_plays = {}
-    album_plays = {}
-    skips = {}
-    total_time = 0
+    if store is None:
+        store = PlayStore()
+    store.thaw()
+    old_rows = len(store)
 
+    # Overlapping exports repeat plays, so skip any already stored or seen earlier in this ingest
+    with stage("dedup index"):
+        seen = play_set(store)
+    duplicates = {}
     for play in data:
         # TODO: Introduce with multithreading.
-        # play_date = date(play)
+        # play_date = store.date(index)
         # STARTFILTER = min(play_date, STARTFILTER)
         # ENDFILTER = max(play_date, ENDFILTER)
 
-        # uri = play["spotify_track_uri"]
-
-        artist = play["master_metadata_album_artist_name"]
-        track = play["master_metadata_track_name"]
-        album = play["master_metadata_album_album_name"]
-        if DUPLICATES and track in DUPLICATES:
-            song = (track, artist, album) # Include album to differentiate
-        else:
-            song = (track, artist) # Otherwise assume songs from different albums are the same
-        
-        if artist is None or track is None:
+        if play["master_metadata_album_artist_name"] is None or play["master_metadata_track_name"] is None:
             continue
+        index = store.append(play)
+        # Duplicates are rare, so appending first and taking them back out saves parsing every timestamp twice
+        if not seen.add(play_key(store.ts[index], play["spotify_track_uri"], play["master_metadata_track_name"], play["ms_played"])):
+            store.pop()
+            source = play.get("source")
+            duplicates[source] = duplicates.get(source, 0) + 1
+    for source, count in duplicates.items():
+        print(f"Skipped {count} duplicate play(s) in {source}")
+        store.duplicates[source] = store.duplicates.get(source, 0) + count
+
+    # Keep the store in time order so that every grouping built from it is too.
+    # Sorting moves the stored rows when new plays fall between them, which the saved aggregates point to.
+    reordered = store.sort()
+    with stage("aggregate"):
+        if pd is not None and not reordered:
+            return group_plays(store, pd, old_rows)
+        return group_plays(store)
+
+def play_set(store):
+    seen = PlaySet(len(store))
+    for ts, uri, track, ms_played in zip(store.ts, store.uri, store.track, store.ms_played):
+        seen.add(play_key(ts, store.uris[uri], store.tracks[track], ms_played))
+    return seen
+
+def play_key(ts, uri, track, ms_played):
+    # Plays are the same when they start at the same second, are the same item and ran as long.
+    # Episodes never reach the store, and local files without a URI fall back to the track name.
+    return hash((ts, uri or track, ms_played))
+
+def group_plays(store, pd=None, start=0):
+    # Group store rows from start on, adding them to the aggregates of pd when given
+    if pd is None:
+        song_plays = {}
+        artist_plays = {}
+        album_plays = {}
+        skips = {}
+        total_time = 0
+        plays = Plays() # Every counted play
+        song_ids = array("l") # Song of each counted play, numbered in order of song_plays
+        rollups = None
+    else:
+        song_plays, artist_plays, album_plays, skips = pd.song_plays, pd.artist_plays, pd.album_plays, pd.skips
+        total_time, plays, song_ids, rollups = pd.total_time, pd.plays, pd.song_ids, pd.rollups
+    song_index = {song: i for i, song in enumerate(song_plays)}
+    first_play = len(plays)
+
+    columns = zip(*(islice(getattr(store, name), start, None) for name in ("track", "artist", "album", "ms_played", "skipped")))
+    for index, (track_id, artist_id, album_id, time, skip) in enumerate(columns, start):
+        artist = store.artists[artist_id]
+        track = store.tracks[track_id]
+        album = store.albums[album_id]
+        song = song_key(track, artist, album)
+
         if IGNORE and artist in IGNORE:
             continue
 
         # Playtime
-        time = play["ms_played"]
-        skip = play["skipped"]
         if time > 30000:
             total_time += time
         elif skip:
             if song not in skips:
-                skips[song] = []
-            skips[song].append(play)
+                skips[song] = Plays()
+            skips[song].append(index, time)
             continue
 
         # Artist plays
         if artist not in artist_plays:
-            artist_plays[artist] = []
-        artist_plays[artist].append(play)
+            artist_plays[artist] = Plays()
+        artist_plays[artist].append(index, time)
 
         # Album plays
         if album not in album_plays:
-            album_plays[album] = []
-        album_plays[album].append(play)
+            album_plays[album] = Plays()
+        album_plays[album].append(index, time)
 
         # Track plays
         if song not in song_plays:
-            song_plays[song] = []
-        song_plays[song].append(play)
+            song_plays[song] = Plays()
+            song_index[song] = len(song_index)
+        song_plays[song].append(index, time)
+
+        plays.append(index, time)
+        song_ids.append(song_index[song])
+
+    # Unique track counts of the aggregates the new rows went into
+    for groups in (song_plays, artist_plays, album_plays, skips):
+        for group in groups.values():
+            if group.last >= start:
+                group.tracks = group.unique(store)
+
+    rollups = build_rollups(store, plays, rollups, first_play)
+    return ProcessedData(store, song_plays, artist_plays, album_plays, skips, total_time, plays, song_ids, rollups)
+
+def rollup_shapes(store, months):
+    # ((entity kind, period kind), entities, periods) of each cube, in the order cells are filled
+    for entity, entities in (("artist", len(store.artists)), ("album", len(store.albums)), ("all", 1)):
+        for period, periods in (("month", months), ("weekday", 7), ("hour", 24)):
+            yield (entity, period), entities, periods
+
+def song_key(track, artist, album):
+    if DUPLICATES and track in DUPLICATES:
+        return (track, artist, album) # Include album to differentiate
+    return (track, artist) # Otherwise assume songs from different albums are the same
+
+def build_rollups(store, plays, rollups=None, start=0):
+    # Export timestamps are UTC, so each is shifted into TIMEZONE before bucketing.
+    # Counted plays from start on are added to a copy of rollups when given, grown to fit new months and names.
+    ts = store.ts
+    day_offsets = {}
+    def local(timestamp):
+        # UTC offsets only change within a day at DST switches, so most days are looked up once
+        utc_day = timestamp // 86400
+        if utc_day not in day_offsets:
+            start, end = utc_offset(utc_day * 86400), utc_offset(utc_day * 86400 + 86399)
+            day_offsets[utc_day] = start if start == end else None
+        offset = day_offsets[utc_day]
+        return timestamp + (utc_offset(timestamp) if offset is None else offset)
+
+    if rollups is None or not rollups.months:
+        rollups, start = None, 0
+        first_month = month_number(local(ts[plays.first])) if plays else 0
+    else:
+        first_month = rollups.first_month
+    months = month_number(local(ts[plays.last])) - first_month + 1 if plays else 0
+    cubes = {}
+    for kind, entities, periods in rollup_shapes(store, months):
+        cubes[kind] = Cube(entities, periods)
+        if rollups is not None:
+            cubes[kind].fill(rollups.cubes[kind])
+
+    month_cells = {}
+    cells = [(cube.counts, cube.ms_played) for cube in cubes.values()]
+    for row in islice(plays.rows, start, None):
+        day, seconds = divmod(local(ts[row]), 86400)
+        if day not in month_cells:
+            month_cells[day] = month_number(day * 86400) - first_month
+        month, weekday, hour = month_cells[day], (day + 3) % 7, seconds // 3600 # 1 January 1970 was a Thursday
+        artist, album = store.artist[row], store.album[row]
+        cell_ids = (
+            artist * months + month, artist * 7 + weekday, artist * 24 + hour,
+            album * months + month, album * 7 + weekday, album * 24 + hour,
+            month, weekday, hour,
+        )
+        ms_played = store.ms_played[row]
+        for (counts, ms), cell in zip(cells, cell_ids):
+            counts[cell] += 1
+            ms[cell] += ms_played
+    return Rollups(first_month, months, cubes)
+
+def utc_offset(timestamp):
+    # Seconds TIMEZONE is ahead of UTC at an epoch time
+    if TIMEZONE is None:
+        return calendar.timegm(time.localtime(timestamp)) - timestamp
+    return int(datetime.fromtimestamp(timestamp, TIMEZONE).utcoffset().total_seconds())
+
+def timezone_key():
+    # Identifies the zone rollups were bucketed in, the system zone by its names and standard offset
+    if TIMEZONE is not None:
+        return TIMEZONE.key
+    return f"system {'/'.join(time.tzname)} {time.timezone}"
+
+def timezone_name():
+    return TIMEZONE.key if TIMEZONE is not None else time.strftime("%Z") or "local time"
+
+def set_timezone(name):
+    global TIMEZONE
+    TIMEZONE = ZoneInfo(name) if name else None
+
+def month_number(timestamp):
+    date = EPOCH + timedelta(seconds=timestamp)
+    return date.year * 12 + date.month - 1
+
+def analyse_sessions(pd, lo, hi, gap=None):
+    # Single pass over the time ordered plays in store rows [lo, hi)
+    gap = SESSIONGAP if gap is None else gap
+    store = pd.store
+    ts, ms_played, artist, album = store.ts, store.ms_played, store.artist, store.album
+    start, end = pd.plays.span(lo, hi)
+
+    runs = [[(0, -1, -1), None, 0, -1] for _ in range(3)] # Best run, current value, length, first row
+    count = seconds = session_plays = 0
+    longest = (0, 0, -1, -1)
+    first = last = -1
+    for row, song in zip(islice(pd.plays.rows, start, end), islice(pd.song_ids, start, end)):
+        # Back to back runs of the same song, artist and album
+        for run, value in zip(runs, (song, artist[row], album[row])):
+            if value == run[1]:
+                run[2] += 1
+            else:
+                run[1], run[2], run[3] = value, 1, row
+            if run[2] > run[0][0]:
+                run[0] = (run[2], run[3], row)
+
+        # Sessions split by gaps between the end of a play and the start of the next
+        if last < 0 or ts[row] - ms_played[row] // 1000 - ts[last] > gap:
+            if last >= 0:
+                length = ts[last] - ts[first] + ms_played[first] // 1000
+                count, seconds = count + 1, seconds + length
+                longest = max(longest, (length, session_plays, first, last))
+            first, session_plays = row, 0
+        last, session_plays = row, session_plays + 1
+    if last >= 0:
+        length = ts[last] - ts[first] + ms_played[first] // 1000
+        count, seconds = count + 1, seconds + length
+        longest = max(longest, (length, session_plays, first, last))
+
+    return Sessions(runs[0][0], runs[1][0], runs[2][0], count, seconds, end - start, longest)
 
-    return ProcessedData(song_plays, artist_plays, album_plays, skips, total_time)
+def run_cmd(pd, cmd, top_songs):
+    # Run one query command, returning the track list that make and prefetch use next
+    match cmd:
+        case Cmd.MAKE.text:
+            make_cmd(pd, top_songs)
+        case Cmd.PREFETCH.text:
+            prefetch_cmd(pd, top_songs)
+        case Cmd.RESULT.text:
+            result_cmd()
+        case Cmd.FILTER.text:
+            filter_cmd()
+        case Cmd.SUMMARY.text:
+            print_summary(pd)
+        case Cmd.ARTISTS.text:
+            print_object(Cmd.ARTISTS, pd.artist_plays, pd.store)
+        case Cmd.ARTIST.text:
+            top_songs = artist_cmd(pd)
+        case Cmd.TRACKS.text:
+            top_songs = print_object(Cmd.TRACKS, pd.song_plays, pd.store)
+        case Cmd.TRACK.text:
+            track_cmd(pd)
+        case Cmd.ALBUMS.text:
+            print_object(Cmd.ALBUMS, pd.album_plays, pd.store)
+        case Cmd.ALBUM.text:
+            top_songs = album_cmd(pd)
+        case Cmd.SKIPS.text:
+            top_songs = print_object(Cmd.SKIPS, pd.skips, pd.store)
+        case Cmd.MONTHLY.text:
+            rollup_cmd(pd, "month")
+        case Cmd.WEEKDAYS.text:
+            rollup_cmd(pd, "weekday")
+        case Cmd.HOURS.text:
+            rollup_cmd(pd, "hour")
+        case Cmd.TOPMONTHLY.text:
+            top_monthly_cmd(pd)
+        case Cmd.REPEATS.text:
+            print_repeats(pd)
+        case Cmd.SESSIONS.text:
+            print_sessions(pd)
+        case Cmd.SHARDS.text:
+            shards_cmd(pd)
+        case Cmd.MERGED.text:
+            merged_cmd()
+        case Cmd.OVERLAP.text:
+            overlap_cmd()
+    return top_songs
 
-def date(play):
-    return datetime.strptime(play["ts"], "%Y-%m-%dT%H:%M:%SZ")
+def start_profile(mode):
+    global PROFILE
+    PROFILE = {}
+    if mode == "memory":
+        tracemalloc.start()
+
+def stage(name):
+    # Shared no-op context unless --profile is on, so stages cost next to nothing otherwise
+    if PROFILE is None:
+        return NO_STAGE
+    return Stage(name)
+
+def record_stage(name, seconds, allocated=0):
+    with PROFILE_LOCK:
+        stats = PROFILE.setdefault(name, [0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += seconds
+        # Peaks of separate calls do not add up, so the largest is kept
+        stats[2] = max(stats[2], allocated)
+
+def stats_cmd(option=""):
+    if PROFILE is None:
+        print("Profiling is off. Start with --profile to record stage timings.")
+        return
+    if option.strip() == "reset":
+        PROFILE.clear()
+        print("Cleared stage timings.")
+        return
+    if not PROFILE:
+        print("No stages recorded yet.")
+        return
+    memory = tracemalloc.is_tracing()
+    print(f"{'Stage':<24} {'Calls':>7} {'Total ms':>10} {'Mean ms':>9}" + (f" {'Peak alloc':>11}" if memory else ""))
+    for name, (calls, seconds, allocated) in sorted(PROFILE.items(), key=lambda item: item[1][1], reverse=True):
+        line = f"{name:<24} {calls:>7} {seconds * 1000:>10.1f} {seconds * 1000 / calls:>9.2f}"
+        if memory:
+            line += f" {allocated / 2**20:>7.1f} MiB"
+        print(line)
+
+def profile_cmd(pd, top_songs):
+    cmd = input("Which command? ").strip()
+    if cmd not in RUN_CMDS:
+        print("Unknown command. Type 'help' for a list of commands.")
+        return top_songs
+    path = data_folder() / f"profile-{cmd}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    before = tracemalloc.take_snapshot().filter_traces(ignore)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        top_songs = run_cmd(pd, cmd, top_songs)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+        if not tracing:
+            tracemalloc.stop()
+
+    print("=" * shutil.get_terminal_size().columns)
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(PROFILELINES)
+    print("Allocations held after the command, by change:")
+    for stat in snapshot.compare_to(before, "lineno")[:PROFILELINES]:
+        print(stat)
+    profiler.dump_stats(path.with_suffix(".prof"))
+    snapshot.dump(str(path.with_suffix(".tracemalloc")))
+    print(f"Wrote {path.name}.prof and {path.name}.tracemalloc to {path.parent}")
+    return top_songs
+
+def rollup_cmd(pd, period):
+    artist_name = input("Which artist? (leave empty for all) ").strip()
+    if not artist_name:
+        return print_rollup(pd, "all", 0, period)
+    match_list = search_index(pd).artists.extract(artist_name, ARTIST_SCORERS, limit=1, score_cutoff=50)
+    if not match_list:
+        print("Could not find artist.")
+        return
+    print_rollup(pd, "artist", pd.store.artists.index(match_list[0][0]), period, match_list[0][0])
+
+def print_rollup(pd, entity, entity_id, period, name="all artists"):
+    print("=" * shutil.get_terminal_size().columns)
+    if period != "month" and (STARTFILTER != datetime.min or ENDFILTER != datetime.max):
+        print(f"Filters are not applied to {period} breakdowns.")
+
+    labels, series = rollup_series(pd, entity, entity_id, period, STARTFILTER, ENDFILTER)
+    if not any(count for count, _ in series):
+        print("No plays found.")
+        return
+    print(f"Listening by {period} for {name} ({timezone_name()}):")
+    for label, (count, play_time) in zip(labels, series):
+        if count:
+            print(f"{label}: {count} plays, {play_time // 3600000} hours {(play_time // 60000) % 60} minutes")
+
+def top_monthly_cmd(pd):
+    entity = "album" if input("Artists or albums? ").strip().lower().startswith("album") else "artist"
+    print("=" * shutil.get_terminal_size().columns)
+    names = pd.store.albums if entity == "album" else pd.store.artists
+    found = False
+    for label, rows in top_monthly(pd, entity, STARTFILTER, ENDFILTER, RESULTS):
+        found = True
+        print(f"{label}:")
+        for i, (entity_id, count, play_time) in enumerate(rows):
+            print(f"  {i+1}. {names[entity_id]}, played {count} times for {play_time // 3600000} hours {(play_time // 60000) % 60} minutes")
+    if not found:
+        print("No plays found.")
+
+def rollup_series(pd, entity, entity_id, period, startfilter, endfilter):
+    # Filters only narrow the months, weekday and hour cubes cover the whole history
+    rollups = pd.rollups
+    cube = rollups.cubes[entity, period]
+    if period == "month":
+        start, end = rollups.month_range(epoch(startfilter), epoch(endfilter))
+        labels = [month_label(rollups.first_month + month) for month in range(start, end)]
+    else:
+        start, end = 0, cube.periods
+        labels = WEEKDAYS if period == "weekday" else [f"{hour:02d}:00" for hour in range(24)]
+    return labels, cube.series(entity_id, start, end)
+
+def top_monthly(pd, entity, startfilter, endfilter, results):
+    rollups = pd.rollups
+    cube = rollups.cubes[entity, "month"]
+    start, end = rollups.month_range(epoch(startfilter), epoch(endfilter))
+    for month in range(start, end):
+        # Rank by time played, as the albums and artists commands do
+        rows = [(entity_id, count, play_time) for entity_id, (count, play_time) in enumerate(cube.period(month)) if count]
+        if rows:
+            yield month_label(rollups.first_month + month), top_k(rows, results, key=itemgetter(2))
+
+def month_label(number):
+    return datetime(number // 12, number % 12 + 1, 1).strftime("%B %Y")
+
+def print_repeats(pd):
+    print("=" * shutil.get_terminal_size().columns)
+    store = pd.store
+    sessions = analyse_sessions(pd, *store.window(epoch(STARTFILTER), epoch(ENDFILTER)))
+    if sessions.track_run[0] == 0:
+        print("No plays found.")
+        return
+    for name, (length, first, last) in (("track", sessions.track_run), ("artist", sessions.artist_run), ("album", sessions.album_run)):
+        if name == "track":
+            object = f"{store.track_name(first)} by {store.artist_name(first)}"
+        elif name == "artist":
+            object = store.artist_name(first)
+        else:
+            object = store.album_name(first)
+        print(f"Longest {name} repeat: {object}, played {length} times in a row from {store.date(first).strftime('%-d %B, %Y')} to {store.date(last).strftime('%-d %B, %Y')}")
+
+def print_sessions(pd):
+    print("=" * shutil.get_terminal_size().columns)
+    store = pd.store
+    sessions = analyse_sessions(pd, *store.window(epoch(STARTFILTER), epoch(ENDFILTER)))
+    if sessions.count == 0:
+        print("No plays found.")
+        return
+    seconds, plays, first, last = sessions.longest
+    started = store.date(first) - timedelta(milliseconds=store.ms_played[first])
+    print(f"Sessions: {sessions.count} (split by gaps over {SESSIONGAP // 60} minutes)")
+    print(f"Average session: {sessions.seconds // sessions.count // 60} minutes, {sessions.plays / sessions.count:.1f} plays")
+    print(f"Longest session: {seconds // 3600} hours {(seconds // 60) % 60} minutes, {plays} plays, from {started.strftime('%-d %B, %Y %H:%M')} to {store.date(last).strftime('%-d %B, %Y %H:%M')}")
+
+def batch_queries(args):
+    queries = list(args.query)
+    if args.script:
+        with open(args.script) as file:
+            queries += [line.strip() for line in file if line.strip() and not line.lstrip().startswith("#")]
+    return queries
+
+def parse_query(text):
+    tokens = shlex.split(text)
+    cmd = next((cmd for cmd in BATCH_CMDS if cmd.text == tokens[0]), None) if tokens else None
+    if cmd is None:
+        raise ValueError(f"Unknown batch command: {text}")
+    query = Query(text, cmd, results=RESULTS)
+    name = []
+    for token in tokens[1:]:
+        key, sep, value = token.partition("=")
+        if not sep or key not in QUERY_OPTIONS:
+            name.append(token)
+            continue
+        match key:
+            case "results":
+                query.results = int(value)
+            case "start":
+                query.start = naive_utc(parser.parse(value))
+            case "end":
+                query.end = naive_utc(parser.parse(value))
+            case "artist":
+                query.artist = value
+            case "shard":
+                query.shard = value
+    query.name = " ".join(name)
+    if query.end < query.start:
+        raise ValueError("Invalid filters. Start date must be before end date.")
+    return query
+
+def naive_utc(dt):
+    # Dates with an offset are compared with the naive UTC defaults and store times, so drop it after converting
+    return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo else dt
+
+def run_batch(pd, queries, workers):
+    global BATCH_DATA
+    BATCH_DATA = pd
+    if workers <= 1 or len(queries) <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return [batch_query(text) for text in queries]
+    # Forked workers inherit the loaded data, so only query text and result rows cross processes.
+    # The search index is built once here rather than once per worker.
+    if any(word in SEARCH_QUERIES for text in queries for word in text.split()[:1]):
+        search_index(pd)
+    with ProcessPoolExecutor(min(workers, len(queries)), mp_context=multiprocessing.get_context("fork")) as pool:
+        return list(pool.map(batch_query, queries))
+
+def batch_query(text):
+    try:
+        query = parse_query(text)
+        if query.shard and query.shard not in SHARDS:
+            raise LookupError(f"Unknown shard: {query.shard}")
+        return {"query": text, "rows": run_query(SHARDS[query.shard] if query.shard else BATCH_DATA, query)}
+    except (ValueError, LookupError, OverflowError, TypeError) as e:
+        return {"query": text, "error": str(e)}
+
+def run_query(pd, query):
+    store = pd.store
+    lo, hi = store.window(epoch(query.start), epoch(query.end))
+    match query.cmd:
+        case Cmd.SUMMARY:
+            return [{
+                "plays": sum(len(song) for song in pd.song_plays.values()),
+                "unique_songs": len(pd.song_plays),
+                "unique_artists": len(pd.artist_plays),
+                "ms_played": pd.total_time
+            }]
+        case Cmd.TRACKS:
+            return ranked_rows(Cmd.TRACKS, pd.song_plays, store, lo, hi, query.results)
+        case Cmd.SKIPS:
+            return ranked_rows(Cmd.SKIPS, pd.skips, store, lo, hi, query.results)
+        case Cmd.ARTISTS:
+            return ranked_rows(Cmd.ARTISTS, pd.artist_plays, store, lo, hi, query.results)
+        case Cmd.ALBUMS:
+            return ranked_rows(Cmd.ALBUMS, pd.album_plays, store, lo, hi, query.results)
+        case Cmd.ARTIST:
+            artist = find_artist(pd, query.name)
+            artist_song_plays = {song: pd.song_plays[song] for song in search_index(pd).artist_songs(artist)}
+            return ranked_rows(Cmd.TRACKS, artist_song_plays, store, lo, hi, query.results)
+        case Cmd.ALBUM:
+            if not query.name:
+                raise LookupError("No album given")
+            match_list = search_index(pd).albums.extract(query.name, ALBUM_SCORERS, limit=1, score_cutoff=70)
+            if not match_list:
+                raise LookupError(f"Could not find album: {query.name}")
+            return ranked_rows(Cmd.TRACKS, album_songs(pd, match_list[0][0]), store, lo, hi, query.results)
+        case Cmd.TRACK:
+            # Batch queries cannot ask which song was meant, so the best match is used
+            artist = find_artist(pd, query.artist)
+            search = search_index(pd)
+            match_list = search.songs.extract(query.name, TRACK_SCORERS, limit=1, score_cutoff=80, positions=search.artist_positions[artist])
+            if not match_list:
+                raise LookupError(f"Could not find song: {query.name} by {artist}")
+            song = match_list[0][0]
+            return ranked_rows(Cmd.TRACK, {song: pd.song_plays[song]}, store, lo, hi, query.results)
+        case Cmd.MONTHLY | Cmd.WEEKDAYS | Cmd.HOURS:
+            period = {Cmd.MONTHLY: "month", Cmd.WEEKDAYS: "weekday", Cmd.HOURS: "hour"}[query.cmd]
+            if query.name:
+                entity, entity_id = "artist", store.artists.index(find_artist(pd, query.name))
+            else:
+                entity, entity_id = "all", 0
+            labels, series = rollup_series(pd, entity, entity_id, period, query.start, query.end)
+            return [{period: label, "plays": count, "ms_played": play_time} for label, (count, play_time) in zip(labels, series) if count]
+        case Cmd.TOPMONTHLY:
+            entity = "album" if query.name.lower().startswith("album") else "artist"
+            names = store.albums if entity == "album" else store.artists
+            return [
+                {"month": label, "rank": i + 1, entity: names[entity_id], "plays": count, "ms_played": play_time}
+                for label, rows in top_monthly(pd, entity, query.start, query.end, query.results)
+                for i, (entity_id, count, play_time) in enumerate(rows)
+            ]
+        case Cmd.REPEATS:
+            sessions = analyse_sessions(pd, lo, hi)
+            if sessions.track_run[0] == 0:
+                return []
+            return [
+                {"repeat": name, "track": store.track_name(first), "artist": store.artist_name(first), "album": store.album_name(first),
+                 "length": length, "from": iso_date(store, first), "to": iso_date(store, last)}
+                for name, (length, first, last) in (("track", sessions.track_run), ("artist", sessions.artist_run), ("album", sessions.album_run))
+            ]
+        case Cmd.SESSIONS:
+            sessions = analyse_sessions(pd, lo, hi)
+            if sessions.count == 0:
+                return []
+            seconds, plays, first, last = sessions.longest
+            started = store.date(first) - timedelta(milliseconds=store.ms_played[first])
+            return [{
+                "sessions": sessions.count,
+                "seconds": sessions.seconds,
+                "plays": sessions.plays,
+                "longest_seconds": seconds,
+                "longest_plays": plays,
+                "longest_from": started.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "longest_to": iso_date(store, last)
+            }]
+
+def find_artist(pd, artist_name):
+    match_list = search_index(pd).artists.extract(artist_name, ARTIST_SCORERS, limit=1, score_cutoff=50)
+    if not match_list:
+        raise LookupError(f"Could not find artist: {artist_name}")
+    return match_list[0][0]
+
+def ranked_rows(cmd, object_plays, store, lo, hi, results):
+    rows = []
+    for i, (object, count, play_time, first_play) in enumerate(rank_objects(cmd, object_plays, store, lo, hi, results)[1]):
+        if cmd in (Cmd.TRACKS, Cmd.TRACK, Cmd.SKIPS):
+            row = {"rank": i + 1, "track": object[0], "artist": object[1]}
+            if len(object) >= 3:
+                row["album"] = object[2]
+        else:
+            row = {"rank": i + 1, cmd.text[:-1]: object}
+        row["skips" if cmd == Cmd.SKIPS else "plays"] = count
+        row["ms_played"] = play_time
+        row["first_played"] = iso_date(store, first_play)
+        if cmd != Cmd.TRACKS and cmd != Cmd.TRACK:
+            row["first_track"] = store.track_name(first_play)
+        rows.append(row)
+    return rows
+
+def iso_date(store, row):
+    return store.date(row).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def write_results(results, format, out):
+    if format == "json":
+        json.dump(results, out, indent=2, ensure_ascii=False)
+        out.write("\n")
+        return
+    # One CSV row per result row, with the columns of every query in the batch
+    fields = {"query": None}
+    for result in results:
+        for row in result.get("rows", ()):
+            fields.update(dict.fromkeys(row))
+    if any("error" in result for result in results):
+        fields["error"] = None
+    writer = csv.DictWriter(out, list(fields))
+    writer.writeheader()
+    for result in results:
+        if "error" in result:
+            writer.writerow({"query": result["query"], "error": result["error"]})
+        for row in result.get("rows", ()):
+            writer.writerow({"query": result["query"], **row})
+
+def serve(pd, path):
+    # Build the search index up front so it is never built by two requests at once
+    search_index(pd)
+    try:
+        asyncio.run(serve_queries(pd, path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        path.unlink(missing_ok=True)
+    print("Stopped server.")
+
+async def serve_queries(pd, path):
+    # Each request is one JSON line of queries, answered with the formatted results before the connection closes
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    async def handle(reader, writer):
+        request = None
+        try:
+            request = json.loads(await reader.readline())
+            if request.get("stop"):
+                stopped.set()
+                response = "Stopping server.\n"
+            else:
+                # Queries run off the event loop so other clients can still connect
+                results = await loop.run_in_executor(None, run_batch, pd, request.get("queries", []), 1)
+                out = io.StringIO()
+                write_results(results, request.get("format", "json"), out)
+                response = out.getvalue()
+        except (ValueError, AttributeError) as e:
+            response = f"Invalid request: {e}\n"
+        except Exception as e:
+            # Anything else is a bug, but the client still gets a reply and the server keeps serving
+            print(f"Error answering {request!r}: {e!r}")
+            response = f"Server error: {e!r}\n"
+        writer.write(response.encode())
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+    path.unlink(missing_ok=True)
+    server = await asyncio.start_unix_server(handle, path=str(path))
+    os.chmod(path, 0o600)
+    print(f"Serving queries on {path}. Stop with Ctrl-C or spotifystats_client.py --stop")
+    async with server:
+        await stopped.wait()
+
+def parse_ts(ts):
+    # Fixed "YYYY-MM-DDTHH:MM:SSZ" format, caching the epoch of each day since histories span few days
+    day = ts[:10]
+    if day not in DAYS:
+        DAYS[day] = calendar.timegm((int(ts[:4]), int(ts[5:7]), int(ts[8:10]), 0, 0, 0))
+    return DAYS[day] + int(ts[11:13]) * 3600 + int(ts[14:16]) * 60 + int(ts[17:19])
+
+def epoch(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+def timezone_arg(name):
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise argparse.ArgumentTypeError(f"unknown time zone: {name}")
+    return name
 
 def parse_args():
     parser = argparse.ArgumentParser(description="A tool to analyse your spotify data")
+    parser.add_argument("--data", action="append", help="Folder of export files, given once per account to load each as its own shard (default .data)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of processes used to parse export files and run batch queries")
+    parser.add_argument("--playlist-limit", type=int, default=PLAYLISTLIMIT, help="Most tracks the make command will put in a playlist")
+    parser.add_argument("--rebuild-cache", action="store_true", help="Ignore the snapshot of processed data and re-ingest every export file")
+    parser.add_argument("--query", action="append", default=[], help="Run a query such as 'tracks results=20 start=2024-01-01' instead of prompting, may be repeated")
+    parser.add_argument("--script", help="Run the queries in a file, one per line, instead of prompting")
+    parser.add_argument("--format", choices=("json", "csv"), default="json", help="Output format of --query and --script results")
+    parser.add_argument("--profile", nargs="?", const="time", choices=("time", "memory"), help="Record time spent in each stage for the stats command, with peak allocations if 'memory' is given")
+    parser.add_argument("--serve", action="store_true", help="Keep the data loaded and answer queries from spotifystats_client.py over a Unix socket")
+    parser.add_argument("--tz", type=timezone_arg, help="Time zone such as Australia/Sydney that month, weekday and hour breakdowns use (default the system zone)")
+    parser.add_argument("--socket", help=f"Unix socket used by --serve (default {SOCKET_FILE} in the first --data folder)")
     args = parser.parse_args()
+    args.data = args.data or [".data"]
     main(args)
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+"""Send queries to a running `myspotifystats.py --serve` and print the results.
+
+Only the standard library is imported so each call starts in milliseconds.
+"""
+import argparse
+import json
+import os
+import shlex
+import socket
+import sys
+
+SOCKET = os.path.join(".data", ".socket")
+ERRORS = ("Invalid request:", "Server error:") # Replies that answer no query
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a running spotifystats server")
+    parser.add_argument("words", nargs="*", metavar="query", help="A query such as: tracks results=20 start=2024-01-01")
+    parser.add_argument("--query", action="append", default=[], help="Another query to run, may be repeated")
+    parser.add_argument("--script", help="Run the queries in a file, one per line")
+    parser.add_argument("--format", choices=("json", "csv"), default="json", help="Output format of the results")
+    parser.add_argument("--socket", default=SOCKET, help="Unix socket the server listens on, .socket in its first --data folder unless it was started with --socket")
+    parser.add_argument("--stop", action="store_true", help="Stop the server")
+    args = parser.parse_args()
+
+    if args.stop:
+        request = {"stop": True}
+    else:
+        # A single word is taken as a whole query, as --query is, so it may be quoted with its arguments
+        if len(args.words) == 1:
+            queries = args.words + args.query
+        else:
+            queries = ([shlex.join(args.words)] if args.words else []) + args.query
+        if args.script:
+            with open(args.script) as file:
+                queries += [line.strip() for line in file if line.strip() and not line.lstrip().startswith("#")]
+        if not queries:
+            parser.error("no queries given")
+        request = {"queries": queries, "format": args.format}
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(args.socket)
+            client.sendall(json.dumps(request).encode() + b"\n")
+            chunks = []
+            while chunk := client.recv(1 << 16):
+                chunks.append(chunk)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.exit(f"No server on {args.socket}. Start one with: python myspotifystats.py --serve")
+    reply = b"".join(chunks).decode()
+    if not reply:
+        sys.exit(f"No reply from the server on {args.socket}")
+    if reply.startswith(ERRORS):
+        sys.exit(reply.rstrip("\n"))
+    sys.stdout.write(reply)
+
+if __name__ == "__main__":
+    main()